@@ -1,39 +1,85 @@
 #!/usr/bin/env python3
 """Convert an anime-planet.com export to MyAnimeList XML format."""
 
-from xml.dom import minidom
-import xml.etree.cElementTree as ET
+import abc
 import argparse
 import csv
 import datetime
+import gzip
+import io
+import shutil
+import tempfile
 import json
 import math
+import multiprocessing
 import time
 import requests
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+import hashlib
+import socket
+from contextlib import contextmanager
+import re
+import threading
+from array import array
+from difflib import SequenceMatcher
 from datetime import date
 import sys, os
 import webbrowser
 from dotenv import load_dotenv
 import urllib.parse
 from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
+
+# --workers processes re-import this script when they spawn
+is_worker = multiprocessing.parent_process() is not None
 
 start_time = datetime.datetime.now()
 start_datetime = start_time.strftime("%Y-%m-%d_%H%M%S")
-qtime = datetime.datetime.now()
+# provider -> time of its last request, each API has its own rate budget
+qtimes = {}
 sys.stdout.reconfigure(encoding='utf-8')
 
 load_dotenv()
 MAL_CLIENT_ID = os.getenv('MAL_CLIENT_ID')
 
+# days a search that found nothing is not retried, by reason
+NEGATIVE_TTLS = {
+    'no_results': 30,
+    'bad_request': 90,
+    'too_short': 365,
+    'skipped': 7,
+}
+
+# how much each kind of agreement counts towards a search result's confidence score
+MATCH_WEIGHTS = {
+    'title': 0.4,
+    'start_year': 0.2,
+    'num_eps': 0.15,
+    'studio': 0.15,
+    'ep_length': 0.05,
+    'media_type': 0.05,
+}
+# the best result must lead the next one by this much to be accepted automatically
+MATCH_MARGIN = 0.05
+
+# Anime Planet media types under their MAL names
+MEDIA_TYPES = {
+    'web': 'ona',
+    'tv special': 'special',
+    'dvd special': 'special',
+    'music video': 'music',
+}
+
 DEFAULTS = {
     'api_delay': 2.0, # in seconds
     'log_file': 'logs/anitransfer/anitransfer_'+start_datetime+'.txt',
     'cache_file': 'mappings/anime_cache.csv',
     'bad_file': 'mappings/anime_bad.csv',
     'unmapped_file': 'mappings/anime_unmapped.csv',
+    'negative_file': 'mappings/anime_negative.csv',
+    'suggestions_file': 'mappings/anime_suggestions.json',
     'skip_confirm': False,
     'cache_only': False,
     'with_mal_links': False,
@@ -44,9 +90,45 @@ DEFAULTS = {
     'num_options': 6,
     'search_queue': False,
     'cache_verify': False,
+    'compact_mappings': False,
+    'import_dump': False,
+    'plan': False,
+    'queue_order': 'priority',
+    'worker_id': socket.gethostname() + '-' + str(os.getpid()),
+    'lease_ttl': 900, # in seconds
+    'mal_client_id': None,
+    'quiet': False,
     'mal_api_store': False,
+    'refresh_store': False,
+    'store_ttl': 7, # in days
     'use_mal_store': False,
     'anime_list': 'export-anime.json',
+    'output_file': 'convert.xml',
+    'output': None,
+    'batch': False,
+    'output_dir': 'converted',
+    'serve': False,
+    'host': '127.0.0.1',
+    'port': 8410,
+    'coalesce_ttl': 3600, # in seconds
+    'aliases': True,
+    'franchise': True,
+    'retry_negative': False,
+    'benchmark': False,
+    'match_benchmark': False,
+    'candidates_file': None,
+    'workers': 1,
+    'hedge': False,
+    'hedge_delay': 3.0, # in seconds
+    'connect_timeout': 5.0, # in seconds
+    'read_timeout': 20.0, # in seconds
+    'max_api_calls': -1,
+    'max_runtime': -1, # in minutes
+    'match_threshold': 0.9,
+    'title_match_threshold': 1.1, # above 1, title-only scores are never accepted
+    'suggest': False,
+    'suggest_workers': 4,
+    'refresh_suggestions': False,
     'limit': -1,
     'offset': 0,
 }
@@ -83,6 +165,28 @@ def parse_arguments():
         help='Cache file to use for anime mappings that have not been reviewed yet',
         default=DEFAULTS['unmapped_file']
     )
+    parser.add_argument(
+        '--negative-file',
+        help='Cache file to use for searches that found nothing',
+        default=DEFAULTS['negative_file']
+    )
+    parser.add_argument(
+        '--negative-ttl',
+        help='Days before retrying a failed search as REASON=DAYS, reasons: ' + ', '.join(NEGATIVE_TTLS),
+        action='append',
+        default=[]
+    )
+    parser.add_argument(
+        '--retry-negative',
+        help='Searches titles again even if an earlier search found nothing.',
+        default=DEFAULTS['retry_negative'],
+        action='store_true'
+    )
+    parser.add_argument(
+        '--suggestions-file',
+        help='File holding ranked search results computed by --suggest for later review',
+        default=DEFAULTS['suggestions_file']
+    )
     parser.add_argument(
         '--skip-confirm',
         help='Skip any confirmation prompts that show up, still tries initial search for entries',
@@ -125,6 +229,42 @@ def parse_arguments():
         default=DEFAULTS['mal_api'],
         action='store_true'
     )
+    parser.add_argument(
+        '--hedge',
+        help='Also searches the other API (MAL or Jikan) when the chosen one is slow, using whichever answers first. Requires MAL_CLIENT_ID.',
+        default=DEFAULTS['hedge'],
+        action='store_true'
+    )
+    parser.add_argument(
+        '--hedge-delay',
+        help='Seconds to wait for the chosen API before hedging with the other one',
+        default=DEFAULTS['hedge_delay'],
+        type=float
+    )
+    parser.add_argument(
+        '--connect-timeout',
+        help='Seconds to wait for an API connection before giving up on the request',
+        default=DEFAULTS['connect_timeout'],
+        type=float
+    )
+    parser.add_argument(
+        '--read-timeout',
+        help='Seconds to wait for an API response before giving up on the request',
+        default=DEFAULTS['read_timeout'],
+        type=float
+    )
+    parser.add_argument(
+        '--max-api-calls',
+        help='Stops searching after this many API requests, progress is kept for the next run',
+        default=DEFAULTS['max_api_calls'],
+        type=int
+    )
+    parser.add_argument(
+        '--max-runtime',
+        help='Stops searching after this many minutes, progress is kept for the next run',
+        default=DEFAULTS['max_runtime'],
+        type=float
+    )
     parser.add_argument(
         '--limit',
         help='Limits the number of entries to process',
@@ -149,38 +289,257 @@ def parse_arguments():
         default=DEFAULTS['search_queue'],
         action='store_true'
     )
+    parser.add_argument(
+        '--suggest',
+        help='Searches the unmapped queue without prompting and saves ranked results for a later --search-queue review.',
+        default=DEFAULTS['suggest'],
+        action='store_true'
+    )
+    parser.add_argument(
+        '--suggest-workers',
+        help='Number of parallel searches used by --suggest, requests still respect --api-delay',
+        default=DEFAULTS['suggest_workers'],
+        type=int
+    )
+    parser.add_argument(
+        '--refresh-suggestions',
+        help='Searches titles that already have saved suggestions again with --suggest.',
+        default=DEFAULTS['refresh_suggestions'],
+        action='store_true'
+    )
     parser.add_argument(
         '--cache-verify',
         help='Automatically checks title matches of cache file.',
         default=DEFAULTS['cache_verify'],
         action='store_true'
     )
+    parser.add_argument(
+        '--quiet',
+        help='Only prints summaries to the console, the log file is unchanged.',
+        default=DEFAULTS['quiet'],
+        action='store_true'
+    )
+    parser.add_argument(
+        '--worker-id',
+        help='Name of this process in queue leases and lock files, when several workers share the mapping files.',
+        default=DEFAULTS['worker_id']
+    )
+    parser.add_argument(
+        '--lease-ttl',
+        help='Seconds a queued title claimed by a worker stays claimed before another worker may take it over.',
+        default=DEFAULTS['lease_ttl'],
+        type=int
+    )
+    parser.add_argument(
+        '--mal-client-id',
+        help='MAL API client ID to use instead of MAL_CLIENT_ID from the .env file, e.g. one per worker.',
+        default=DEFAULTS['mal_client_id']
+    )
+    parser.add_argument(
+        '--queue-order',
+        help='Order the search queue is worked through: titles most likely to be found first, or file order.',
+        default=DEFAULTS['queue_order'],
+        choices=['priority', 'file']
+    )
+    parser.add_argument(
+        '--plan',
+        help='Estimates the searches, API calls, runtime and output size of a run without making it.',
+        default=DEFAULTS['plan'],
+        action='store_true'
+    )
+    parser.add_argument(
+        '--import-dump',
+        help='Imports a MAL metadata dump (JSON array, JSON lines or CSV, optionally gzipped) into the MAL store and exits.',
+        default=DEFAULTS['import_dump']
+    )
+    parser.add_argument(
+        '--compact-mappings',
+        help='Removes duplicate and conflicting rows from the mapping files and sorts them.',
+        default=DEFAULTS['compact_mappings'],
+        action='store_true'
+    )
     parser.add_argument(
         '--mal-api-store',
         help='Automatically stores MAL API entry details for local use later.',
         default=DEFAULTS['mal_api_store'],
         action='store_true'
     )
+    parser.add_argument(
+        '--refresh-store',
+        help='Re-fetches stored MAL entries older than --store-ttl that are still airing or have unknown episode or chapter counts.',
+        default=DEFAULTS['refresh_store'],
+        action='store_true'
+    )
+    parser.add_argument(
+        '--store-ttl',
+        help='Days before a stored MAL entry that may still change is refreshed by --refresh-store',
+        default=DEFAULTS['store_ttl'],
+        type=float
+    )
     parser.add_argument(
         '--use-mal-store',
         help='Automatically stores MAL API entry details for local use later.',
         default=DEFAULTS['use_mal_store'],
         action='store_true'
     )
+    parser.add_argument(
+        '--coalesce-ttl',
+        help='Seconds a search answer is reused for titles that normalize to the same query',
+        default=DEFAULTS['coalesce_ttl'],
+        type=int
+    )
+    parser.add_argument(
+        '--no-aliases',
+        help='Disables matching title variants of already mapped titles before searching',
+        dest='aliases',
+        default=DEFAULTS['aliases'],
+        action='store_false'
+    )
+    parser.add_argument(
+        '--no-franchise',
+        help='Disables matching titles against the related entries of mapped titles of the same franchise',
+        dest='franchise',
+        default=DEFAULTS['franchise'],
+        action='store_false'
+    )
+    parser.add_argument(
+        '--match-threshold',
+        help='Confidence score (0-1) above which the best search result is accepted without confirmation, above 1 disables it',
+        default=DEFAULTS['match_threshold'],
+        type=float
+    )
+    parser.add_argument(
+        '--title-match-threshold',
+        help='Like --match-threshold for scores of the title alone (no Anime Planet info), above 1 (the default) disables it',
+        default=DEFAULTS['title_match_threshold'],
+        type=float
+    )
+    parser.add_argument(
+        '--match-benchmark',
+        help='Replays the mapped and bad titles through the matching logic and reports its accuracy and speed, then exits.',
+        default=DEFAULTS['match_benchmark'],
+        action='store_true'
+    )
+    parser.add_argument(
+        '--candidates-file',
+        help='JSON lines file search results are recorded to, and replayed from by --match-benchmark',
+        default=DEFAULTS['candidates_file']
+    )
+    parser.add_argument(
+        '--benchmark',
+        help='Runs the offline microbenchmarks and exits.',
+        default=DEFAULTS['benchmark'],
+        action='store_true'
+    )
     parser.add_argument(
         '--anime-list',
         help='Anime Planet JSON export file to process. Not needed when using --search-queue.',
         default=DEFAULTS['anime_list']
     )
+    parser.add_argument(
+        '--output-file',
+        help='MAL XML file to write the converted list to.',
+        default=DEFAULTS['output_file']
+    )
+    parser.add_argument(
+        '--output',
+        help='Output FORMAT[:PATH] to write, repeatable. Formats are xml and json (AniList entries), add .gz to compress. Without PATH it is named after --output-file.',
+        default=DEFAULTS['output'],
+        action='append'
+    )
+    parser.add_argument(
+        '--workers',
+        help='Number of processes that classify and convert list entries in parallel.',
+        default=DEFAULTS['workers'],
+        type=int
+    )
+    parser.add_argument(
+        '--batch',
+        help='Directory of Anime Planet JSON exports (or manifest file listing one export path per line) to convert in one run.',
+        default=DEFAULTS['batch']
+    )
+    parser.add_argument(
+        '--output-dir',
+        help='Folder to write one converted file per user to when using --batch.',
+        default=DEFAULTS['output_dir']
+    )
+    parser.add_argument(
+        '--serve',
+        help='Runs a local HTTP conversion service that keeps mappings loaded between requests.',
+        default=DEFAULTS['serve'],
+        action='store_true'
+    )
+    parser.add_argument(
+        '--host',
+        help='Address the conversion service listens on.',
+        default=DEFAULTS['host']
+    )
+    parser.add_argument(
+        '--port',
+        help='Port the conversion service listens on.',
+        default=DEFAULTS['port'],
+        type=int
+    )
 
     args = parser.parse_args()
+
+    for ttl in args.negative_ttl:
+        reason, _, days = ttl.partition('=')
+        if reason not in NEGATIVE_TTLS or not days.isdigit():
+            parser.error('--negative-ttl expects REASON=DAYS, reasons: ' + ', '.join(NEGATIVE_TTLS))
+        NEGATIVE_TTLS[reason] = int(days)
+
+    for spec in args.output or []:
+        fmt = spec.partition(':')[0]
+        if fmt not in ('xml', 'json', 'xml.gz', 'json.gz'):
+            parser.error('--output expects FORMAT[:PATH], formats: xml, json, xml.gz, json.gz')
+
     return args
 
 args = parse_arguments()
 
-if args.selenium:
+if args.mal_client_id:
+    MAL_CLIENT_ID = args.mal_client_id
+
+if args.selenium and not is_worker:
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
     service = Service(executable_path="chromedriver.exe")
     driver = webdriver.Chrome(service=service)
+    driver.set_page_load_timeout(args.read_timeout)
+
+# one pooled connection set shared by every API request in the run
+session = requests.Session()
+
+# orjson is used when installed, otherwise the standard library parser
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def jsonLoads(data):
+    """Parses JSON from bytes or str with the fastest available backend."""
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+def jsonDumps(data):
+    """Encodes data as compact JSON text."""
+    if orjson is not None:
+        return orjson.dumps(data).decode('utf-8')
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+#Loads JSON file
+def loadJSON(filename):
+    with open(filename, 'rb') as f:
+        return jsonLoads(f.read())
+
+def saveJSON(data, filename):
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(jsonDumps(data))
+
 
 def processCacheFiles(file):
     with open(file, newline='', encoding='utf-8') as f:
@@ -189,75 +548,647 @@ def processCacheFiles(file):
         
     return data
 
-cache_data = processCacheFiles(args.cache_file)
-bad_data = processCacheFiles(args.bad_file)
-#unmapped_data = processCacheFiles(args.unmapped_file)
+# seconds a lock file may exist before it is treated as left behind by a crashed process
+LOCK_STALE = 60
+
+lock_guards = {}
+lock_guards_guard = threading.Lock()
+
+@contextmanager
+def fileLock(path):
+    """Holds an exclusive lock on a shared file across threads, processes and machines.
+
+    The lock is a path.lock file created with O_CREAT | O_EXCL, which is atomic
+    on local disks and shared storage alike.
+    """
+    with lock_guards_guard:
+        guard = lock_guards.setdefault(path, threading.Lock())
+
+    lock_file = path + '.lock'
+    # who holds the lock, only the holder removes it
+    token = args.worker_id + ' ' + str(os.getpid()) + ' ' + os.urandom(8).hex()
+    with guard:
+        while True:
+            try:
+                fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                held = lockToken(lock_file)
+                try:
+                    if held is not None and time.time() - os.path.getmtime(lock_file) > LOCK_STALE:
+                        breakStaleLock(lock_file, held)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.05)
+
+        try:
+            os.write(fd, (token + '\n').encode('utf-8'))
+            os.close(fd)
+            yield
+        finally:
+            if lockToken(lock_file) == token:
+                os.remove(lock_file)
+            else:
+                logger.warning("Lock was taken over while held: " + lock_file)
+
+def lockToken(lock_file):
+    try:
+        with open(lock_file, encoding='utf-8') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def breakStaleLock(lock_file, token):
+    """Removes a stale lock, but only if it still holds the token that was found stale.
+
+    The lock is renamed aside first, which is atomic, so a lock another worker
+    took in the meantime is put back instead of removed.
+    """
+    aside = tmpName(lock_file) + '.stale'
+    try:
+        os.rename(lock_file, aside)
+    except FileNotFoundError:
+        return
+    if lockToken(aside) == token:
+        logger.warning("Removing stale lock: " + lock_file)
+    else:
+        try:
+            os.link(aside, lock_file)
+        except OSError:
+            logger.warning("Couldn't put back a lock taken over meanwhile: " + lock_file)
+    os.remove(aside)
+
+def tmpName(path):
+    # unique per process, so workers replacing the same file don't share a temp file
+    return path + '.' + str(os.getpid()) + '.tmp'
+
+def appendRows(file, rows):
+    with open(file, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerows(rows)
+
+# mapping file -> (inode, bytes read), so rows appended by other workers can be read alone
+mapping_offsets = {}
+
+def readMappingRows(file, offset=0):
+    """Reads a mapping file from a byte offset and remembers how far it was read.
+
+    Partial rows at the end of a later read are left for the next one.
+    """
+    with open(file, 'rb') as f:
+        inode = os.fstat(f.fileno()).st_ino
+        f.seek(offset)
+        data = f.read()
+
+    end = len(data) if offset == 0 else data.rfind(b'\n') + 1
+    mapping_offsets[file] = (inode, offset + end)
+    return list(csv.reader(io.StringIO(data[:end].decode('utf-8'), newline='')))
+
+def newMappingRows(file):
+    """Returns the rows appended since the file was read, None if it was replaced since."""
+    inode, offset = mapping_offsets.get(file, (None, 0))
+    stat = os.stat(file)
+    if stat.st_ino != inode or stat.st_size < offset:
+        return None
+    if stat.st_size == offset:
+        return []
+    return readMappingRows(file, offset)
+
+def mappingFiles():
+    return [args.cache_file, args.bad_file, args.unmapped_file]
+
+def mappingMtimes():
+    mtimes = {}
+    for file in mappingFiles():
+        mtimes[file] = os.path.getmtime(file)
+    return mtimes
+
+# set by loadMappings(), the mtimes the loaded indexes match
+mapping_mtimes = None
+
+class MappingTable:
+    """Title to MAL ID mappings stored as columns.
+
+    Titles are interned and IDs live in an integer array, so a row costs far less
+    than a list of two strings. Iterating yields [title, id] rows in file order.
+    """
+    __slots__ = ('titles', 'ids', 'rows')
+
+    def __init__(self, data=()):
+        self.titles = []
+        self.ids = array('l')
+        self.rows = {}
+        for row in data:
+            self.append(row[0], row[1])
+
+    def append(self, title, mal_id):
+        title = sys.intern(title)
+        self.rows.setdefault(title, len(self.titles))
+        self.titles.append(title)
+        self.ids.append(int(mal_id))
+
+    def get(self, title):
+        """Returns the MAL ID of the first row for a title, or None."""
+        row = self.rows.get(title)
+        if row is None:
+            return None
+        return str(self.ids[row])
+
+    def __contains__(self, title):
+        return title in self.rows
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __iter__(self):
+        for title, mal_id in zip(self.titles, self.ids):
+            yield [title, str(mal_id)]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        return [self.titles[index], str(self.ids[index])]
+
+def titleSet(data):
+    return set(sys.intern(row[0]) for row in data if row)
+
+def demandRows(data):
+    """Maps queued titles to how many exports contained them, in queue order, and to the exports counted.
+
+    Rows with a third column count one export each, once per export. Rows
+    without one are older counts and are added as they are.
+    """
+    index = {}
+    exports = {}
+    for row in data:
+        if not row:
+            continue
+        title = sys.intern(row[0])
+        if len(row) > 2 and row[2]:
+            counted = exports.setdefault(title, set())
+            if row[2] in counted:
+                index.setdefault(title, 0)
+                continue
+            counted.add(row[2])
+            demand = 1
+        else:
+            demand = int(row[1]) if len(row) > 1 and row[1].isdigit() else 1
+        index[title] = index.get(title, 0) + demand
+    return index, exports
+
+def demandIndex(data):
+    """Maps queued titles to how many exports contained them, in queue order."""
+    return demandRows(data)[0]
+
+def exportKey(data):
+    """Returns who an export belongs to: a hash of its user name, or of its entries without one.
+
+    Only hashes go into the shared queue file, never the user names themselves.
+    """
+    user = data.get('user') or {}
+    if isinstance(user, dict) and user.get('name'):
+        return 'user:' + hashlib.sha1(str(user['name']).encode('utf-8')).hexdigest()[:16]
+    return 'export:' + hashlib.sha1(jsonDumps(data.get('entries', [])).encode('utf-8')).hexdigest()[:16]
+
+ORDINALS = {'first': 1, 'second': 2, 'third': 3, 'fourth': 4, 'fifth': 5, 'sixth': 6, 'seventh': 7, 'eighth': 8, 'ninth': 9, 'tenth': 10}
+ORDINAL_PART = re.compile(r'\b(\d+)(?:st|nd|rd|th) (season|part)\b')
+ORDINAL_WORD_PART = re.compile(r'\b(' + '|'.join(ORDINALS) + r') (season|part)\b')
+TRAILING_YEAR = re.compile(r'\s*\(?\b(?:19|20)\d\d\)?\s*$')
+# punctuation ending a title, closing brackets belong to the title
+TRAILING_MARKS = re.compile(r'[^\w\s)\]]*(?:\s+[^\w\s)\]]+)*$')
+
+def aliasKey(title):
+    """Returns the form shared by spellings of the same title.
+
+    Case, most punctuation, "2nd Season"/"Second Season"/"Season 2" and plural
+    "Recaps"/"Specials" don't change which entry a title means. Marks that tell
+    sequels apart ("Gintama'", "Gintama.", "K-On!!", "Love Is War?") are kept,
+    and so are any marks ending the title ("Nisekoi:", "Ojamajo Doremi #").
+    """
+    title = str(title).replace('\u2019', "'").replace('\u2018', "'").casefold().strip()
+    trailing = TRAILING_MARKS.search(title).group()
+    title = title[:len(title) - len(trailing)].replace('&', ' and ')
+    title = re.sub(r"[^\w\s!?'.\u00b0]|_", ' ', title)
+    title = ORDINAL_PART.sub(r'\2 \1', title)
+    title = ORDINAL_WORD_PART.sub(lambda m: m.group(2) + ' ' + str(ORDINALS[m.group(1)]), title)
+    title = re.sub(r'\b(recap|special)s\b', r'\1', title)
+    return " ".join(title.split()) + trailing.replace(' ', '')
+
+def lossyAliasKey(title):
+    """Returns the title without its subtitle or trailing year, these often mean another entry."""
+    title = str(title).split(':')[0]
+    return aliasKey(TRAILING_YEAR.sub('', title))
+
+def addAlias(index, key, title, mal_id):
+    # keys shared by titles of different entries can't pick one
+    known = index.get(key, False)
+    if known is False:
+        index[key] = (title, mal_id)
+    elif known is not None and known[1] != mal_id:
+        index[key] = None
+
+def addAliases(title, mal_id):
+    if alias_index is None:
+        return
+    addAlias(alias_index, aliasKey(title), title, mal_id)
+    addAlias(lossy_alias_index, lossyAliasKey(title), title, mal_id)
+
+# built on the first alias lookup, runs that only read the cache never need it
+alias_index = None
+lossy_alias_index = None
+
+# trailing words that name one part of a franchise rather than the franchise
+FRANCHISE_SUFFIX = re.compile(r'(?:\s+(?:season|part|movie|movies|film|ova|ona|special|recap|the|final|r?\d+|i{1,3}|iv|v|vi{1,3}|ix|x))+$')
+
+def franchiseKey(title):
+    """Returns the franchise name of a title, without subtitle, season, part or year."""
+    # sequel marks ("K-On!!") tell entries apart, not franchises
+    key = re.sub(r'[^\w\s]', '', lossyAliasKey(title))
+    return FRANCHISE_SUFFIX.sub('', ' ' + key).strip()
+
+def addFranchise(title, mal_id):
+    if franchise_index is None:
+        return
+    key = franchiseKey(title)
+    if len(key) >= 3:
+        franchise_index.setdefault(key, {}).setdefault(mal_id, title)
+
+# franchise name -> {MAL ID: mapped title}, built on the first franchise lookup
+franchise_index = None
+
+def loadFranchises():
+    global franchise_index
+    franchise_index = {}
+    for title, mal_id in cache_data:
+        addFranchise(title, mal_id)
+
+def loadAliases():
+    """Indexes the variants of every mapped title."""
+    global alias_index, lossy_alias_index
+    alias_index = {}
+    lossy_alias_index = {}
+    for title, mal_id in cache_data:
+        addAliases(title, mal_id)
+
+def loadMappings():
+    """Loads the mapping files into the in-memory lookup indexes.
+
+    The indexes are kept in sync by cache(), bad(), queueUnmapped() and
+    removeUnmapped(), so this only needs to run again when another process
+    changes the files.
+    """
+    global cache_data, bad_index, unmapped_index, mapping_mtimes, alias_index, franchise_index
+
+    mapping_mtimes = mappingMtimes()
+    cache_data = MappingTable(row for row in readMappingRows(args.cache_file) if row)
+    bad_index = titleSet(readMappingRows(args.bad_file))
+    unmapped_index = demandIndex(processCacheFiles(args.unmapped_file))
+    alias_index = None
+    franchise_index = None
+
+def syncMappings():
+    """Adds the cache and bad rows other workers appended since the files were read."""
+    cacheRows = newMappingRows(args.cache_file)
+    badRows = newMappingRows(args.bad_file)
+    if cacheRows is None or badRows is None:
+        loadMappings()
+        return
+
+    for row in cacheRows:
+        if len(row) >= 2 and row[0] not in cache_data:
+            cache_data.append(row[0], row[1])
+            addAliases(row[0], row[1])
+            addFranchise(row[0], row[1])
+    bad_index.update(sys.intern(row[0]) for row in badRows if row)
+
+def ownMappingWrite(file):
+    """Records a write this process made to a mapping file it read back in full under its lock.
+
+    The loaded index already holds the file's rows, so reloadMappings() has no
+    reason to parse the files again for it.
+    """
+    if mapping_mtimes is not None and file in mapping_mtimes:
+        mapping_mtimes[file] = os.path.getmtime(file)
+
+def reloadMappings():
+    """Reloads the mapping indexes if a mapping file changed on disk."""
+    if mappingMtimes() == mapping_mtimes:
+        return False
+    loadMappings()
+    return True
+
+loadMappings()
+
+def loadNegative():
+    """Loads failed searches, the last row for a title wins."""
+    global negative_index
+    negative_index = {}
+    if not os.path.isfile(args.negative_file):
+        return
+
+    for row in processCacheFiles(args.negative_file):
+        if len(row) < 3 or row[0] in cache_data:
+            continue
+        count = int(row[3]) if len(row) > 3 and row[3].isdigit() else 1
+        negative_index[row[0]] = [row[1], row[2], count]
+
+loadNegative()
+
+def loadSuggestions():
+    global suggestion_index
+    suggestion_index = {}
+    if os.path.isfile(args.suggestions_file):
+        suggestion_index = loadJSON(args.suggestions_file)
+
+loadSuggestions()
+
+# pass as extra= for records that --quiet still prints
+SUMMARY = {'summary': True}
+
+class SummaryFilter(logging.Filter):
+    def __init__(self, level=logging.CRITICAL + 1):
+        super().__init__()
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno >= self.level or getattr(record, 'summary', False)
+
+class LogQueueHandler(QueueHandler):
+    """Queues records as they are, they never leave this process."""
+    def prepare(self, record):
+        return record
+
+def consoleHandler():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    if args.quiet:
+        handler.addFilter(SummaryFilter())
+    return handler
+
+log_queue = queue.Queue()
+log_listener = None
 
 def setupLogger(LOG_FILE_NAME = str(date.today())+".log"):
-    """Sets up and returns a log file to be used during a script."""
+    """Sets up and returns a log file to be used during a script.
+
+    Records go through a queue to a background thread that writes the console
+    and the log file, so logging doesn't hold up the caller.
+    """
+    global log_listener
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.DEBUG)
 
-    consoleHandler = logging.StreamHandler(sys.stdout)
+    # worker processes would truncate the main process's log file
+    if is_worker:
+        logger.addHandler(consoleHandler())
+        return logger
+
     fileHandler = logging.FileHandler(filename=LOG_FILE_NAME, mode='w', encoding='utf-8')
-    consoleHandler.setLevel(logging.DEBUG)
     fileHandler.setLevel(logging.WARNING)
-    
-    consoleFormatter = logging.Formatter('%(message)s')
     fileFormatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    consoleHandler.setFormatter(consoleFormatter)
     fileHandler.setFormatter(fileFormatter)
 
-    logger.addHandler(consoleHandler)
-    logger.addHandler(fileHandler)
+    log_listener = QueueListener(log_queue, consoleHandler(), fileHandler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    queueHandler = LogQueueHandler(log_queue)
+    if args.quiet:
+        # the rest would only be dropped by both handlers
+        queueHandler.addFilter(SummaryFilter(fileHandler.level))
+    logger.addHandler(queueHandler)
 
     return logger
 
-logger = setupLogger(args.log_file)
+def flushLog():
+    """Waits until queued records are written, so prompts and redraws come after them."""
+    if log_listener is not None:
+        log_queue.join()
 
-#Loads JSON file
-def loadJSON(filename):
-    f = open(filename, encoding='utf-8')
-    data = json.load(f)
-    f.close()
-    return data
+def progress(count, total):
+    if not args.quiet:
+        flushLog()
+        print("PROGRESS: " + str(count) + " / " + str(total))
+
+def clearScreen():
+    flushLog()
+    sys.stdout.write("\033[H\033[2J")
+    sys.stdout.flush()
+
+logger = setupLogger(args.log_file)
 
 def cache(name, malid):
-    with open(args.cache_file, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
-        writer.writerow([name, malid])
+    with fileLock(args.cache_file):
+        # another worker may have mapped the title meanwhile, the first mapping stays
+        syncMappings()
+        known = cacheSearch(name)
+        if known is False:
+            appendRows(args.cache_file, [[name, malid]])
+            mapping_offsets[args.cache_file] = (mapping_offsets[args.cache_file][0], os.path.getsize(args.cache_file))
+            cache_data.append(name, malid)
+            addAliases(name, malid)
+            addFranchise(name, malid)
+        elif known != malid:
+            logger.warning("Already mapped by another worker: " + name + " ---> " + known + " (not " + malid + ")")
+
+    negative_index.pop(name, None)
 
 def cacheSearch(name):
-    for i in cache_data:
-        if i[0] == name:
-            mal = i[1]
-            #logger.info('Cached ID found: ' + name + ' ---> ' + mal)
-            return mal
-    #print('Cached Not found.')
+    malid = cache_data.get(name)
+    if malid is None:
+        return False
+    return malid
+
+def aliasSearch(name):
+    """Matches a title against variants of mapped titles, returns the MAL ID or False.
+
+    Variants that only differ in spelling are accepted, a match that needed the
+    subtitle or year removed is only offered for confirmation.
+    """
+    if not args.aliases:
+        return False
+    if alias_index is None:
+        loadAliases()
+
+    alias = alias_index.get(aliasKey(name))
+    if alias:
+        title, mal_id = alias
+        logger.info("Alias match found: " + title + " ---> " + mal_id)
+        return mal_id
+
+    alias = lossy_alias_index.get(lossyAliasKey(name))
+    if alias and not args.skip_confirm:
+        title, mal_id = alias
+        if aliasConfirm(title, mal_id, "mapped title"):
+            return mal_id
+
     return False
 
+def aliasConfirm(title, mal_id, source):
+    flushLog()
+    answer = input("Possible match with " + source + ": " + title + " ---> " + mal_id + " -- use it? (y/n): ")
+    if answer.strip().lower() == "y":
+        return True
+    elif answer.strip().lower() == "n":
+        return False
+    logger.debug('ERROR: Bad input. Asking again.')
+    return aliasConfirm(title, mal_id, source)
+
 def badSearch(name):
-    for i in bad_data:
-        if i[0] == name:
-            #logger.info('Bad title found: ' + name + ' ---> SKIP')
-            return True
-    return False
+    return name in bad_index
 
 def bad(name):
-    with open(args.bad_file, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
-        writer.writerow([name])
-
-def delayCheck(delay):
-    global qtime
-    now = datetime.datetime.now()
-    dtime = now - qtime
-    secs = dtime.total_seconds()
-    #diff = math.ceil(delay - secs)
-    diff = delay - secs
-    if secs < delay:
-        time.sleep(diff)
-    qtime = datetime.datetime.now()
+    with fileLock(args.bad_file):
+        syncMappings()
+        if name not in bad_index:
+            appendRows(args.bad_file, [[name]])
+            mapping_offsets[args.bad_file] = (mapping_offsets[args.bad_file][0], os.path.getsize(args.bad_file))
+            bad_index.add(sys.intern(name))
+
+negative_lock = threading.Lock()
+
+def negative(name, reason):
+    """Records a search that found nothing so later runs can skip it."""
+    with negative_lock:
+        count = 1
+        if name in negative_index:
+            count = negative_index[name][2] + 1
+        timestamp = datetime.datetime.now().isoformat(timespec='seconds')
+        negative_index[name] = [reason, timestamp, count]
+
+        with fileLock(args.negative_file):
+            appendRows(args.negative_file, [[name, reason, timestamp, count]])
+
+def searchNegative(name, reason, negatives=None):
+    """Records a search that found nothing, or collects the reason when the caller decides."""
+    if negatives is None:
+        negative(name, reason)
+    else:
+        negatives.append(reason)
+
+def negativeCheck(name):
+    """Returns the reason of a failed search that shouldn't be retried yet."""
+    if args.retry_negative or name not in negative_index:
+        return False
+
+    reason, timestamp, count = negative_index[name]
+    # auto skipped titles still show up for manual confirmation
+    if reason == 'skipped' and not args.skip_confirm:
+        return False
+
+    age = datetime.datetime.now() - datetime.datetime.fromisoformat(timestamp)
+    if age.total_seconds() > NEGATIVE_TTLS.get(reason, 0) * 86400:
+        return False
+    return reason
+
+# title -> recorded search results, loaded from --candidates-file on first use
+response_cache = None
+
+def loadResponseCache():
+    """Returns the recorded search results by title, the latest search of a title wins."""
+    recorded = {}
+    if args.candidates_file and os.path.isfile(args.candidates_file):
+        with open(args.candidates_file, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = jsonLoads(line)
+                    recorded[record['title']] = record['entries']
+    return recorded
+
+def cachedResponse(name):
+    """Returns the recorded search results of a title, or None if it wasn't searched before."""
+    global response_cache
+    if response_cache is None:
+        response_cache = loadResponseCache()
+    return response_cache.get(name)
+
+def recordCandidates(name, entries):
+    """Appends the results of a search to --candidates-file for --match-benchmark and later searches to replay."""
+    if not args.candidates_file:
+        return
+    line = jsonDumps({"title": name, "entries": entries})
+    with fileLock(args.candidates_file):
+        with open(args.candidates_file, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+    if response_cache is not None:
+        response_cache[name] = entries
+
+# keeps parallel searches to the same provider spaced by the API delay
+delay_locks = {}
+delay_locks_guard = threading.Lock()
+
+def delayCheck(delay, provider='mal'):
+    with delay_locks_guard:
+        lock = delay_locks.setdefault(provider, threading.Lock())
+
+    # each caller reserves the next free slot and waits for it outside the lock
+    with lock:
+        now = datetime.datetime.now()
+        slot = max(now, qtimes.get(provider, start_time) + datetime.timedelta(seconds=delay))
+        qtimes[provider] = slot
+    wait = (slot - now).total_seconds()
+    if wait > 0:
+        time.sleep(wait)
+
+# exit code of runs stopped by --max-api-calls or --max-runtime, run again to continue
+BUDGET_EXIT_CODE = 75
+
+class BudgetExceeded(Exception):
+    """Raised instead of sending a request once the run is out of budget."""
+
+api_calls = 0
+api_calls_lock = threading.Lock()
+budget_stopped = False
+
+def budgetExceeded():
+    """Returns why the run has to stop searching, or False while it's within budget."""
+    global budget_stopped
+    reason = False
+    if args.max_api_calls > -1 and api_calls >= args.max_api_calls:
+        reason = "API call budget of " + str(args.max_api_calls) + " reached"
+    elif args.max_runtime > 0 and (datetime.datetime.now() - start_time).total_seconds() >= args.max_runtime * 60:
+        reason = "Runtime budget of " + str(args.max_runtime) + " minutes reached"
+
+    if reason and not budget_stopped:
+        budget_stopped = True
+        logger.warning(reason + ", stopping. Progress is saved, run again to continue.", extra=SUMMARY)
+    return reason
+
+def apiGet(url, headers=None):
+    """GETs an API url with the connect and read deadlines, counting it against the budget."""
+    global api_calls
+    with api_calls_lock:
+        if budgetExceeded():
+            raise BudgetExceeded(url)
+        api_calls += 1
+    return session.get(url, headers=headers, timeout=(args.connect_timeout, args.read_timeout))
+
+class Candidate:
+    """A search result offered as a possible match for a title."""
+    __slots__ = ('id', 'titles', 'start_year', 'num_eps', 'ep_length', 'studio', 'media_type', 'score', 'metadata')
+
+    def __init__(self, id, titles, start_year="Unknown", num_eps="?", ep_length="?", studio="", media_type="?", score=None, metadata=False):
+        self.id = id
+        self.titles = titles
+        self.start_year = start_year
+        self.num_eps = num_eps
+        self.ep_length = ep_length
+        self.studio = studio
+        self.media_type = sys.intern(media_type)
+        self.score = score
+        self.metadata = metadata
+
+    @property
+    def link(self):
+        return "https://myanimelist.net/anime/" + self.id
+
+    def toDict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(**{field: data[field] for field in cls.__slots__ if field in data})
 
 def jikanGetTitles(entry):
     titles = [entry['title']]
@@ -273,45 +1204,116 @@ def jikanGetTitles(entry):
             titles.append(synonyms)
     return titles
 
-def jikanSearch(name):
+def jikanGetOption(entry):
+    id = str(entry['mal_id'])
+
+    start_year = "Unknown"
+    if entry.get('year'):
+        start_year = str(entry['year'])
+    elif entry.get('aired') and entry['aired'].get('from'):
+        start_year = entry['aired']['from'].split('-')[0]
+    num_eps = str(entry.get('episodes') or 0)
+    ep_length = "?"
+    duration = jikanDuration(entry.get('duration'))
+    if duration:
+        ep_length = str(round(duration / 60))
+    media_type = str(entry.get('type') or '?').lower()
+
+    studio = ""
+    if len(entry.get('studios') or []) > 0:
+        studio = str(entry['studios'][0]['name'])
+
+    return Candidate(id, jikanGetTitles(entry), start_year, num_eps, ep_length, studio, media_type)
+
+def jikanDuration(duration):
+    """Converts a Jikan duration like "1 hr 25 min" or "24 min per ep" to seconds."""
+    seconds = 0
+    for amount, unit in re.findall(r'(\d+) (hr|min|sec)', duration or ''):
+        seconds += int(amount) * {'hr': 3600, 'min': 60, 'sec': 1}[unit]
+    return seconds or None
+
+def jikanToMal(entry):
+    """Converts a Jikan anime entry into the MAL API fields kept in the MAL store."""
+    malEntry = {
+        "id": entry['mal_id'],
+        "title": entry['title'],
+        "alternative_titles": {
+            "synonyms": entry.get('title_synonyms') or [],
+            "en": entry.get('title_english') or "",
+            "ja": entry.get('title_japanese') or "",
+        },
+    }
+
+    aired = entry.get('aired') or {}
+    if aired.get('from'):
+        malEntry['start_date'] = aired['from'].split('T')[0]
+    if aired.get('to'):
+        malEntry['end_date'] = aired['to'].split('T')[0]
+    if entry.get('type'):
+        malEntry['media_type'] = entry['type'].lower().replace(' ', '_')
+    if entry.get('status'):
+        malEntry['status'] = entry['status'].lower().replace(' ', '_')
+    if entry.get('episodes') is not None:
+        malEntry['num_episodes'] = entry['episodes']
+    if entry.get('season') and entry.get('year'):
+        malEntry['start_season'] = {"year": entry['year'], "season": entry['season']}
+    if entry.get('source'):
+        malEntry['source'] = entry['source'].lower().replace(' ', '_')
+    duration = jikanDuration(entry.get('duration'))
+    if duration:
+        malEntry['average_episode_duration'] = duration
+    malEntry['studios'] = [{"id": studio['mal_id'], "name": studio['name']} for studio in entry.get('studios') or []]
+
+    return malEntry
+
+def jikanMatch(name, anime_planet_info=False, negatives=None):
+    """Searches Jikan without prompting.
+
+    Returns the ID of an automatic match (or False) along with the ranked
+    options, or False if the search failed.
+    """
     try:
         query = urllib.parse.quote_plus(str(name))
         url = "https://api.jikan.moe/v4/anime?q="+query
-        jikan = requests.get(url)
+        jikan = apiGet(url)
         if jikan.status_code == 400:
             logger.error("Jikan 400 -- "+name)
+            searchNegative(name, 'bad_request', negatives)
             return False
-        jfile = jikan.json()
+        jikanData = jsonLoads(jikan.content)
+    except BudgetExceeded:
+        return False
+    except requests.Timeout:
+        logger.error("Jikan request timed out -- "+name)
+        return False
     except:
         logger.error("Jikan request failed -- "+name)
         return False
 
-    jikanData = json.loads(json.dumps(jfile))
     if len(jikanData['data']) == 0:
         logger.error("Jikan search found no entries -- "+name)
+        searchNegative(name, 'no_results', negatives)
         return False
     
-    jikanOptions = []
     jikanEntries = jikanData['data']
+    recordCandidates(name, jikanEntries)
     for entry in jikanEntries:
-        id = str(entry['mal_id'])
-        link = "https://myanimelist.net/anime/"+id
+        mal_store_save(jikanToMal(entry))
 
-        titles = jikanGetTitles(entry)
-        if name.lower() in [x.lower() for x in titles]:
-            logger.info("Jikan match found: "+id)
-            return id
+    jikanOptions = [jikanGetOption(entry) for entry in jikanEntries]
+    match = exactMatch(name, jikanOptions)
+    if match:
+        logger.info("Jikan match found: "+match.id)
+        return (match.id, [match])
 
-        jikanOption = {"id": id, "titles": titles, "link": link}
-        jikanOptions.append(jikanOption)
-    
-    selection = optionSelect(jikanOptions, name)
+    jikanOptions = rankOptions(name, jikanOptions, anime_planet_info)
+    match = confidentMatch(jikanOptions)
+    if match:
+        logger.info("Jikan confident match found (" + str(match.score) + "): " + match.id)
+        logger.info("MAL title: " + match.titles[0])
+        return (match.id, jikanOptions)
 
-    if selection == False:
-        logger.error("Couldn't find title -- "+name)
-        return False
-    
-    return selection
+    return (False, jikanOptions)
 
 def malGetTitles(entry):
     titles = [entry['title']]
@@ -323,91 +1325,236 @@ def malGetTitles(entry):
             titles.append(synonyms)
     return titles
 
-def malSearch(full_name, anime_planet_info=False, assume_match=True):
-    name = full_name
-
-    if len(name) >= 65:
-        name = name[:64]
-        logger.info("Search title too long, shortening: -- " + name)
-        assume_match = False
+# cheap fields for exact title matches, detail fields only for metadata comparison or display
+MAL_SEARCH_FIELDS = "id,title,alternative_titles"
+MAL_DETAIL_FIELDS = "id,title,alternative_titles,start_date,end_date,media_type,status,num_episodes,start_season,source,average_episode_duration,studios"
+MAL_MANGA_FIELDS = "id,title,alternative_titles,start_date,end_date,media_type,status,num_chapters,num_volumes"
 
+def malRequest(name, fields):
+    """Runs a MAL search with the given fields, returns the entries or False."""
     try:
         headers = {'X-MAL-CLIENT-ID': MAL_CLIENT_ID}
         query = urllib.parse.quote_plus(str(name))
         url = "https://api.myanimelist.net/v2/anime?q="+query
-        fields = "id,title,alternative_titles,start_date,end_date,media_type,num_episodes,start_season,source,average_episode_duration,studios"
         url += "&fields="+fields+"&nsfw=true"
-        mal = requests.get(url, headers=headers)
+        mal = apiGet(url, headers=headers)
         if mal.status_code == 400:
             logger.error("MAL 400 -- "+name)
-            return False
-        malFile = mal.json()
+            return 400
+        malData = jsonLoads(mal.content)
+    except BudgetExceeded:
+        return False
+    except requests.Timeout:
+        logger.error("MAL request timed out -- "+name)
+        return False
     except:
         logger.error("MAL request failed -- "+name)
         return False
 
-    malData = json.loads(json.dumps(malFile))
-    if len(malData['data']) == 0:
+    return [entry['node'] for entry in malData['data']]
+
+def malGetOption(entry):
+    id = str(entry['id'])
+
+    start_year = "Unknown"
+    if "start_date" in entry:
+        start_year = str(entry['start_date'].split('-')[0])
+    num_eps = str(entry.get('num_episodes', '?'))
+    ep_length = "?"
+    if 'average_episode_duration' in entry:
+        ep_length = str(round(entry['average_episode_duration'] / 60))
+    media_type = str(entry.get('media_type', '?'))
+
+    studio = ""
+    if len(entry.get('studios', [])) > 0:
+        studio = str(entry['studios'][0]['name'])
+
+    return Candidate(id, malGetTitles(entry), start_year, num_eps, ep_length, studio, media_type)
+
+def malMatch(full_name, anime_planet_info=False, assume_match=True, fetch_details=False, negatives=None):
+    """Searches MAL without prompting.
+
+    Returns the ID of an automatic match (or False) along with the ranked
+    options, or False if the search failed.
+    """
+    name = full_name
+
+    if len(name) >= 65:
+        name = name[:64]
+        logger.info("Search title too long, shortening: -- " + name)
+        assume_match = False
+
+    # details are only requested when they're compared with Anime Planet info or displayed
+    fetch_details = fetch_details or bool(anime_planet_info)
+    malEntries = malRequest(name, MAL_DETAIL_FIELDS if fetch_details else MAL_SEARCH_FIELDS)
+    if malEntries == 400:
+        searchNegative(full_name, 'bad_request', negatives)
+        return False
+    if malEntries == False:
+        return False
+
+    if len(malEntries) == 0:
         logger.error("MAL search found no entries -- "+name)
+        searchNegative(full_name, 'no_results', negatives)
         return False
+    recordCandidates(full_name, malEntries)
+    if fetch_details:
+        for entry in malEntries:
+            mal_store_save(entry)
+
+    if assume_match:
+        match = exactMatch(name, [malGetOption(entry) for entry in malEntries])
+        if match:
+            logger.info("MAL match found: "+match.id)
+            logger.info("MAL title: "+match.titles[0])
+            return (match.id, [match])
 
     malOptions = []
-    malEntries = malData['data']
-    #print(malData['data'][0])
     for entry in malEntries:
-        entry = entry['node']
-        id = str(entry['id'])
-        link = "https://myanimelist.net/anime/"+id
-        
-        start_year = "Unknown"
-        if "start_date" in entry:
-            start_year = str(entry['start_date'].split('-')[0])
-        num_eps = str(entry['num_episodes'])
-        ep_length = str(round(entry['average_episode_duration'] / 60))
-        media_type = str(entry['media_type'])
-
-        studio = ""
-        if len(entry['studios']) > 0:
-            studio = str(entry['studios'][0]['name'])
- 
-        titles = malGetTitles(entry)
-        if assume_match:
-            if name.lower() in [x.lower() for x in titles]:
-                logger.info("MAL match found: "+id)
-                logger.info("MAL title: "+titles[0])
-                return id
+        malOption = malGetOption(entry)
 
         if anime_planet_info:
             ap_start_year = anime_planet_info['start_year']
             ap_num_eps = anime_planet_info['num_eps']
-            ap_ep_length = anime_planet_info['ep_length']
-            ap_media_type = anime_planet_info['media_type']
             ap_studio = anime_planet_info['studio']
 
-            if start_year == ap_start_year and num_eps == ap_num_eps and studio == ap_studio:
-                logger.info("MAL match found: "+id)
-                logger.info("MAL title: "+titles[0])
-                return id
-
-        malOption = {
-            "id": id,
-            "titles": titles,
-            "link": link,
-            "start_year": start_year,
-            "num_eps": num_eps,
-            "ep_length": ep_length,
-            "studio": studio,
-            "media_type": media_type
-        }
+            if malOption.start_year == ap_start_year and malOption.num_eps == ap_num_eps and malOption.studio == ap_studio:
+                logger.info("MAL match found: "+malOption.id)
+                logger.info("MAL title: "+malOption.titles[0])
+                return (malOption.id, [malOption])
+
         malOptions.append(malOption)
-    
-    selection = optionSelect(malOptions, full_name)
 
-    if selection == False:
-        logger.error("Couldn't find title -- "+ full_name)
+    malOptions = rankOptions(full_name, malOptions, anime_planet_info)
+    match = confidentMatch(malOptions)
+    if match:
+        logger.info("MAL confident match found (" + str(match.score) + "): " + match.id)
+        logger.info("MAL title: " + match.titles[0])
+        return (match.id, malOptions)
+
+    return (False, malOptions)
+
+# sequel markers besides digits, single letters are left out ("Hunter x Hunter")
+SEQUEL_NUMERALS = {'ii': '2', 'iii': '3', 'iv': '4', 'vi': '6', 'vii': '7', 'viii': '8', 'ix': '9'}
+SEQUEL_WORDS = dict(ORDINALS, final='final')
+
+def titleNumbers(title):
+    """Returns the numbers of a title, with Roman numerals and season words as numbers."""
+    numbers = []
+    for token in re.findall(r'\d+|[a-z]+', title.casefold()):
+        if token.isdigit():
+            numbers.append(token)
+        elif token in SEQUEL_NUMERALS:
+            numbers.append(SEQUEL_NUMERALS[token])
+        elif token in SEQUEL_WORDS:
+            numbers.append(str(SEQUEL_WORDS[token]))
+    return numbers
+
+def titleSimilarity(name, title):
+    """Scores how alike two titles are from 0 to 1.
+
+    Titles that differ in their numbers (digits, Roman numerals, "Second",
+    "Final") are usually different seasons or movies, so those only get part
+    of the score.
+    """
+    name = normalizeTitle(name)
+    title = normalizeTitle(title)
+    if name == title:
+        return 1.0
+    ratio = SequenceMatcher(None, name, title).ratio()
+    if titleNumbers(name) != titleNumbers(title):
+        ratio *= 0.6
+    return ratio
+
+def metadataAgrees(field, ap_value, mal_value):
+    """Returns whether a field agrees, or None if either side doesn't know it."""
+    ap_value = str(ap_value).strip().lower()
+    mal_value = str(mal_value).strip().lower()
+    if ap_value in ('', '???', '?', 'unknown') or mal_value in ('', '?', 'unknown'):
+        return None
+    if field == 'num_eps' and mal_value == '0':
+        return None
+
+    if field == 'ep_length':
+        if not ap_value.isdigit() or not mal_value.isdigit():
+            return None
+        return abs(int(ap_value) - int(mal_value)) <= 1
+    if field == 'media_type':
+        ap_value = MEDIA_TYPES.get(ap_value, ap_value)
+    return ap_value == mal_value
+
+def scoreOption(name, option, anime_planet_info=False):
+    """Scores a search result by title similarity plus weighted metadata agreement.
+
+    Returns the score and whether any metadata was compared.
+    """
+    score = MATCH_WEIGHTS['title'] * max(titleSimilarity(name, title) for title in option.titles)
+    weights = MATCH_WEIGHTS['title']
+
+    if anime_planet_info:
+        for field, weight in MATCH_WEIGHTS.items():
+            if field == 'title' or field not in anime_planet_info or not hasattr(option, field):
+                continue
+            agrees = metadataAgrees(field, anime_planet_info[field], getattr(option, field))
+            if agrees is None:
+                continue
+            weights += weight
+            if agrees:
+                score += weight
+
+    return (round(score / weights, 3), weights > MATCH_WEIGHTS['title'])
+
+def exactMatch(name, options):
+    """Returns the first search result listing the searched title itself, ignoring case, or False."""
+    name = name.lower()
+    for option in options:
+        if name in [x.lower() for x in option.titles]:
+            return option
+    return False
+
+def rankOptions(name, options, anime_planet_info=False):
+    """Scores the search results and sorts the most likely match first."""
+    for option in options:
+        option.score, option.metadata = scoreOption(name, option, anime_planet_info)
+    return sorted(options, key=lambda option: option.score, reverse=True)
+
+def confidentMatch(options):
+    """Returns the best ranked result if it clears its threshold and leads the rest.
+
+    Scores backed by Anime Planet metadata use --match-threshold, scores of the
+    title alone --title-match-threshold, which is off by default: sequels and
+    seasons of one series often have near identical titles.
+    """
+    if len(options) == 0:
         return False
-    
-    return selection
+    threshold = args.match_threshold if options[0].metadata else args.title_match_threshold
+    if options[0].score < threshold:
+        return False
+    if len(options) > 1 and options[0].score - options[1].score < MATCH_MARGIN:
+        return False
+    return options[0]
+
+def candidateMatch(name, candidates, scoring=True):
+    """Matches a title against recorded search results like malMatch() and jikanMatch().
+
+    Returns (MAL ID or False, how it was decided, the ranked options).
+    """
+    options = [jikanGetOption(entry) if 'mal_id' in entry else malGetOption(entry) for entry in candidates]
+    exactName = name
+    if 'mal_id' not in candidates[0] and len(name) >= 65:
+        # MAL searches are shortened and don't assume exact matches
+        exactName = False
+    match = exactName and exactMatch(exactName, options)
+    if match:
+        return (match.id, 'exact', [match])
+    if not scoring:
+        return (False, None, options)
+
+    options = rankOptions(name, options)
+    match = confidentMatch(options)
+    if match:
+        return (match.id, 'score', options)
+    return (False, None, options)
 
 def printOptionInfo(id, titles, link):
     print("MAL ID: "+id)
@@ -418,12 +1565,18 @@ def printOptionInfo(id, titles, link):
     print()
 
 def prompt(options, numOptions, name):
+    flushLog()
     answer = input('Enter number for correct choice: ')
     if answer.strip() == '':
         return False
     elif answer.strip() == 'i':
-        malID = input("Enter MAL ID: ")
-        return malID
+        malID = input("Enter MAL ID: ").strip()
+        if malID.isdigit():
+            if mal_store_check_by_id(malID):
+                print("MAL title: " + get_mal_store_data_by_id(malID)['title'])
+            return malID
+        logger.debug('ERROR: MAL ID must be a number. Asking again.')
+        return prompt(options, numOptions, name)
     elif answer.strip() == 'b':
         bad(name)
         removeUnmapped(name)
@@ -432,33 +1585,39 @@ def prompt(options, numOptions, name):
         return -1
     elif answer.isdigit() and int(answer) <= numOptions:
         answer = int(answer)-1
-        return options[answer]['id']
+        return options[answer].id
     
     logger.debug('ERROR: Bad input. Asking again.')
     return prompt(options, numOptions, name)
 
 def optionSelect(options, name):
     if args.skip_confirm:
-        print()
+        if not args.quiet:
+            print()
         logger.info('SKIP: Skipping confirmation')
+        negative(name, 'skipped')
         return False
 
+    flushLog()
     numOptions = args.num_options
     print()
     print('[OPTIONS]')
     x = 1
     for option in options:
-        title = option['titles'][0]
-        link = option['link']
+        title = option.titles[0]
+        link = option.link
         print('[' + str(x) + '] ' + title)
         # printOptionInfo(id, titles, link)
+
+        if option.score is not None:
+            print("match: " + str(round(option.score * 100)) + "%")
         
-        if args.mal_api and args.with_mal_info:
-            num_eps = option['num_eps']
-            start_year = option['start_year']
-            ep_length = option['ep_length']
-            media_type = option['media_type']
-            studio = option['studio']
+        if args.with_mal_info:
+            num_eps = option.num_eps
+            start_year = option.start_year
+            ep_length = option.ep_length
+            media_type = option.media_type
+            studio = option.studio
 
             print("year: " + start_year + " -- " + num_eps + " ep -- " + ep_length + " mins -- " + studio + " -- " + media_type)
 
@@ -482,39 +1641,507 @@ def optionSelect(options, name):
 
     return prompt(options, numOptions, name)
 
+class ResolveQuery:
+    """A title being resolved, with its Anime Planet info fetched only if a backend asks.
+
+    Remote backends leave the ranked options of an undecided search on the
+    query for the later backends, along with the reasons of searches that
+    found nothing.
+    """
+    __slots__ = ('name', '_info', 'options', 'asked', 'negatives')
+
+    def __init__(self, name):
+        self.name = name
+        self._info = None
+        self.options = []
+        self.asked = 0
+        self.negatives = []
+
+    @property
+    def anime_planet_info(self):
+        if self._info is None:
+            self._info = getAnimePlanetInfo(self.name) if args.selenium else False
+        return self._info
+
+class Resolver(abc.ABC):
+    """A backend of the resolver chain.
+
+    resolve() returns a MAL ID, False when the title is settled without one
+    (nothing found, skipped) or None to pass the title to the next backend.
+    """
+    name = 'resolver'
+
+    def __init__(self):
+        self.calls = 0
+        self.hits = 0
+        self.settled = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self, query):
+        if not self.applies(query):
+            return None
+        started = time.perf_counter()
+        try:
+            result = self.resolve(query)
+        finally:
+            with self.lock:
+                self.calls += 1
+                self.seconds += time.perf_counter() - started
+        if result is not None:
+            with self.lock:
+                self.settled += 1
+                if result:
+                    self.hits += 1
+        return result
+
+    def applies(self, query):
+        """Returns whether the backend tries the query at all, skipped queries aren't counted."""
+        return True
+
+    @abc.abstractmethod
+    def resolve(self, query):
+        """Returns a MAL ID, False or None for the query."""
+
+class MappingResolver(Resolver):
+    name = 'mappings'
+
+    def resolve(self, query):
+        return cacheSearch(query.name) or None
+
+class AliasResolver(Resolver):
+    name = 'aliases'
+
+    def resolve(self, query):
+        return aliasSearch(query.name) or None
+
+class StoreResolver(Resolver):
+    name = 'mal_store'
+
+    def resolve(self, query):
+        return storeSearch(query.name) or None
+
+class FranchiseResolver(Resolver):
+    name = 'franchise'
+
+    def resolve(self, query):
+        return franchiseSearch(query.name) or None
+
+class NegativeResolver(Resolver):
+    name = 'negative'
+
+    def resolve(self, query):
+        reason = negativeCheck(query.name)
+        if reason:
+            logger.info("Earlier search found nothing (" + reason + "), skipping -- " + query.name)
+            return False
+        return None
+
+class SuggestionResolver(Resolver):
+    name = 'suggestions'
+
+    def resolve(self, query):
+        if query.name not in suggestion_index:
+            return None
+        return suggestionSelect(query.name)
+
+class ResponseCacheResolver(Resolver):
+    """Answers from the search results recorded in --candidates-file instead of searching again."""
+    name = 'responses'
+
+    def resolve(self, query):
+        entries = cachedResponse(query.name)
+        if not entries:
+            return None
+        id, stage, options = candidateMatch(query.name, entries)
+        if id:
+            logger.info("Recorded search match found: " + id)
+            return id
+        query.options = options
+        return None
+
+class RemoteResolver(Resolver):
+    """Searches a provider without prompting, unless an earlier backend already has options.
+
+    Undecided options are left on the query, a search that found nothing
+    leaves its reason.
+    """
+    provider = None
+
+    def applies(self, query):
+        return not query.options
+
+    def resolve(self, query):
+        query.asked += 1
+        result = self.match(query.name, remoteDetails(), query.negatives)
+        if result == False:
+            return None
+        id, options = result
+        if id:
+            return id
+        query.options = options
+        return None
+
+    def match(self, name, fetch_details, negatives):
+        if args.skip_confirm:
+            delayCheck(args.api_delay, self.provider)
+        if self.provider == 'mal':
+            return malMatch(name, False, True, fetch_details, negatives)
+        return jikanMatch(name, False, negatives)
+
+class HedgedResolver(RemoteResolver):
+    name = 'hedged'
+
+    def match(self, name, fetch_details, negatives):
+        # hedgedMatch() records its own failed searches
+        return hedgedMatch(name, False, fetch_details)
+
+class MalResolver(RemoteResolver):
+    name = 'mal'
+    provider = 'mal'
+
+class JikanResolver(RemoteResolver):
+    name = 'jikan'
+    provider = 'jikan'
+
+class SeleniumResolver(Resolver):
+    """Ranks undecided options again with the Anime Planet info of the title (--selenium)."""
+    name = 'selenium'
+
+    def applies(self, query):
+        return bool(query.options)
+
+    def resolve(self, query):
+        anime_planet_info = query.anime_planet_info
+        if not anime_planet_info:
+            return None
+
+        for option in query.options:
+            if option.start_year == anime_planet_info['start_year'] and option.num_eps == anime_planet_info['num_eps'] and option.studio == anime_planet_info['studio']:
+                logger.info("Anime Planet info match found: " + option.id)
+                logger.info("MAL title: " + option.titles[0])
+                return option.id
+
+        query.options = rankOptions(query.name, query.options, anime_planet_info)
+        match = confidentMatch(query.options)
+        if match:
+            logger.info("Anime Planet info confident match found (" + str(match.score) + "): " + match.id)
+            logger.info("MAL title: " + match.titles[0])
+            return match.id
+        return None
+
+class PromptResolver(Resolver):
+    """Asks for the options nobody could decide on, the end of the chain."""
+    name = 'prompt'
+
+    def resolve(self, query):
+        if not query.options:
+            # only record a failed search once every asked provider found nothing
+            if query.asked and len(query.negatives) == query.asked:
+                negative(query.name, query.negatives[0])
+            return False
+        selection = optionSelect(query.options, query.name)
+        if selection == False:
+            logger.error("Couldn't find title -- " + query.name)
+        return selection
+
+def remoteDetails():
+    # details are needed to compare with Anime Planet info or to display them
+    return args.selenium or (args.with_mal_info and not args.skip_confirm)
+
+def resolverChain():
+    """Returns the backends asked for a title, cheapest first.
+
+    Local backends come first, the first backend that settles a title ends the
+    chain. Remote searches don't prompt, Jikan is asked after MAL when MAL
+    found nothing or failed, Anime Planet info (--selenium) is only fetched
+    when the search results are undecided and the options left are asked last.
+    """
+    chain = [MappingResolver()]
+    if args.aliases:
+        chain.append(AliasResolver())
+    chain.append(StoreResolver())
+    chain.append(NegativeResolver())
+    chain.append(SuggestionResolver())
+    if args.candidates_file:
+        chain.append(ResponseCacheResolver())
+    # can fetch related entries and prompt, and only offers matches for confirmation
+    if args.franchise and not args.skip_confirm:
+        chain.append(FranchiseResolver())
+
+    if hedgeEnabled():
+        chain.append(HedgedResolver())
+    elif args.mal_api:
+        chain.append(MalResolver())
+        chain.append(JikanResolver())
+    else:
+        chain.append(JikanResolver())
+    if args.selenium:
+        chain.append(SeleniumResolver())
+    chain.append(PromptResolver())
+    return chain
+
+def logResolverStats():
+    """Logs how often each backend was asked, answered and how long it took."""
+    if not any(resolver.calls for resolver in resolvers):
+        return
+    flushLog()
+    print("=================================")
+    for resolver in resolvers:
+        if resolver.calls == 0:
+            continue
+        hitRate = round(100 * resolver.hits / resolver.calls)
+        latency = round(1000 * resolver.seconds / resolver.calls, 1)
+        stats = str(resolver.calls) + " asked, " + str(resolver.hits) + " found (" + str(hitRate) + "%), "
+        stats += str(resolver.settled - resolver.hits) + " settled without a match, " + str(latency) + " ms avg"
+        logger.info("Resolver " + resolver.name + ": " + stats, extra=SUMMARY)
+
 def search(name):
-    print()
-    print('==============')
-    print('[ANIME PLANET]')
-    print('[*] '+ name)
+    if not args.quiet:
+        print()
+        print('==============')
+        print('[ANIME PLANET]')
+        print('[*] '+ name)
 
     if len(name) < 3:
         logger.error("Search title too small -- " + name)
+        if negativeCheck(name) == False:
+            negative(name, 'too_short')
         return False
 
-    if args.skip_confirm:
-        delayCheck(args.api_delay)
+    query = ResolveQuery(name)
+    result = False
+    for resolver in resolvers:
+        result = resolver(query)
+        if result is not None:
+            break
 
-    anime_planet_info = False
+    if not args.quiet:
+        print('==============')
+        print()
+    return result or False
+
+def searchProvider():
+    return 'mal' if args.mal_api else 'jikan'
+
+def hedgeEnabled():
+    return args.hedge and bool(MAL_CLIENT_ID)
+
+resolvers = resolverChain()
+
+def providerMatch(provider, name, anime_planet_info=False, fetch_details=False, negatives=None):
+    """Searches one provider without prompting, waiting for that provider's delay."""
+    delayCheck(args.api_delay, provider)
+    if provider == 'mal':
+        return malMatch(name, anime_planet_info, True, fetch_details, negatives)
+    return jikanMatch(name, anime_planet_info, negatives)
+
+def usableMatch(result):
+    return result != False and (result[0] or len(result[1]) > 0)
+
+hedge_pool = None
 
+def hedgedMatch(name, anime_planet_info=False, fetch_details=False):
+    """Searches the --mal-api provider and hedges with the other one if it is slow.
+
+    The other provider is asked once the first hasn't answered within
+    --hedge-delay seconds (or answered with nothing usable), and the first usable
+    answer wins. Each provider keeps its own request delay. A failed search is
+    only recorded when every asked provider found nothing.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    global hedge_pool
+    if hedge_pool is None:
+        hedge_pool = ThreadPoolExecutor(max_workers=4)
+
+    primary = searchProvider()
+    secondary = 'jikan' if primary == 'mal' else 'mal'
+
+    negatives = {primary: [], secondary: []}
+    first = hedge_pool.submit(providerMatch, primary, name, anime_planet_info, fetch_details, negatives[primary])
+    done, pending = wait([first], timeout=args.hedge_delay)
+    if done and usableMatch(first.result()):
+        return first.result()
+
+    logger.info("Hedging search with " + secondary + " -- " + name)
+    pending.add(hedge_pool.submit(providerMatch, secondary, name, anime_planet_info, fetch_details, negatives[secondary]))
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if usableMatch(future.result()):
+                return future.result()
+
+    if negatives[primary] and negatives[secondary]:
+        negative(name, negatives[primary][0])
+    return False
+
+def suggestionSelect(name):
+    """Resolves a title from the results saved by --suggest instead of searching."""
+    suggestion = suggestion_index[name]
+    options = [Candidate.fromDict(option) for option in suggestion['options']]
+    if suggestion['match']:
+        match = suggestion['match']
+        if args.skip_confirm:
+            logger.info("Suggested match found: " + match)
+            return match
+        titles = [option.titles[0] for option in options if option.id == match] or [name]
+        if aliasConfirm(titles[0], match, "suggested match"):
+            return match
+
+    selection = optionSelect(options, name)
+    if selection == False:
+        logger.error("Couldn't find title -- " + name)
+        return False
+    return selection
+
+def saveSuggestions():
+    tmp_file = args.suggestions_file + '.tmp'
+    saveJSON(suggestion_index, tmp_file)
+    os.replace(tmp_file, args.suggestions_file)
+
+def suggest(name):
+    """Searches a title without prompting, returns its suggestion or False."""
+    anime_planet_info = False
     if args.selenium:
         anime_planet_info = getAnimePlanetInfo(name)
 
-    if args.mal_api:
-        malResult = malSearch(name, anime_planet_info)
-        print('==============')
-        print()
-        if malResult:
-            return malResult
+    if hedgeEnabled():
+        result = hedgedMatch(name, anime_planet_info, args.with_mal_info)
+    else:
+        result = providerMatch(searchProvider(), name, anime_planet_info, args.with_mal_info)
+
+    if result == False:
         return False
 
-    jikanResult = jikanSearch(name)
+    id, options = result
+    return {
+        "match": id or None,
+        "options": [option.toDict() for option in options[:args.num_options]],
+        "time": datetime.datetime.now().isoformat(timespec='seconds'),
+    }
+
+def suggestQueue():
+    """Saves ranked search results for the unmapped queue so it can be reviewed offline.
 
-    print('==============')
-    print()
-    if jikanResult:
-        return jikanResult
-    return False
+    Searches run in parallel but every request still waits for --api-delay.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    # titles typed differently but searched as the same query share one search
+    queries = {}
+    for count, row in enumerate(queueRows(processCacheFiles(args.unmapped_file))):
+        if count < args.offset:
+            continue
+        if args.limit > -1 and len(queries) >= args.limit:
+            break
+        name = row[0]
+        if name in cache_data or name in bad_index or len(name) < 3 or negativeCheck(name):
+            continue
+        if name in suggestion_index and not args.refresh_suggestions:
+            continue
+        queries.setdefault(normalizeTitle(name), []).append(name)
+    titles = [names[0] for names in queries.values()]
+
+    # the selenium driver can only load one page at a time
+    workers = 1 if args.selenium else max(1, args.suggest_workers)
+    logger.info("Computing suggestions for " + str(len(titles)) + " titles with " + str(workers) + " workers...")
+
+    count = 0
+    suggested = 0
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = {pool.submit(suggest, name): name for name in titles}
+    try:
+        for future in as_completed(futures):
+            name = futures[future]
+            count += 1
+            suggestion = future.result()
+            if suggestion:
+                for title in queries[normalizeTitle(name)]:
+                    suggestion_index[title] = suggestion
+                suggested += 1
+            progress(count, len(titles))
+            if budgetExceeded():
+                for future in futures:
+                    future.cancel()
+                break
+    except KeyboardInterrupt:
+        logger.info("Stopping, saving suggestions found so far...")
+        for future in futures:
+            future.cancel()
+    finally:
+        pool.shutdown(wait=True)
+        saveSuggestions()
+
+    flushLog()
+    print("=================================")
+    logger.info("Suggestions Saved: " + str(suggested), extra=SUMMARY)
+    logger.info("No Results: " + str(len(titles) - suggested), extra=SUMMARY)
+
+def normalizeTitle(name):
+    """Returns the key used to treat differently typed titles as the same query."""
+    name = str(name).replace('\u2019', "'").replace('\u2018', "'")
+    return " ".join(name.casefold().split())
+
+# normalized query -> in-flight or recently answered search
+search_flights = {}
+search_flights_lock = threading.Lock()
+
+def coalescedSearch(name):
+    """Runs search() at most once for every normalized title.
+
+    Callers asking for a title that is already being searched wait for that
+    search and share its answer, answers are reused for --coalesce-ttl seconds.
+    Only found IDs and searches that really found nothing are shared, a skip,
+    a failed request or quitting is asked again.
+    """
+    key = normalizeTitle(name)
+
+    with search_flights_lock:
+        flight = search_flights.get(key)
+        if flight is not None and flight['event'].is_set():
+            age = time.monotonic() - flight['time']
+            if age > args.coalesce_ttl:
+                flight = None
+        owner = flight is None
+        if owner:
+            flight = {"event": threading.Event(), "result": False, "time": 0, "reuse": False}
+            search_flights[key] = flight
+
+    if not owner:
+        flight['event'].wait()
+        if not flight['reuse']:
+            return coalescedSearch(name)
+        logger.info("Reusing search result: " + name + " ---> " + str(flight['result']))
+        return flight['result']
+
+    try:
+        result = search(name)
+        flight['result'] = result
+        flight['time'] = time.monotonic()
+        flight['reuse'] = reusableResult(name, result)
+        if not flight['reuse']:
+            with search_flights_lock:
+                search_flights.pop(key, None)
+    except BaseException:
+        with search_flights_lock:
+            search_flights.pop(key, None)
+        raise
+    finally:
+        flight['event'].set()
+
+    return result
+
+# failed search reasons that are answers about the title, not about this request
+REUSABLE_NEGATIVES = ('no_results', 'bad_request', 'too_short')
+
+def reusableResult(name, result):
+    """Whether a search result can be given to other callers of the same title."""
+    if result == -1:
+        return False
+    if result:
+        return True
+    return negativeCheck(name) in REUSABLE_NEGATIVES
 
 def getAnimePlanetInfo(name):
     anime_planet_info = {}
@@ -592,7 +2219,8 @@ def getAnimePlanetInfo(name):
     #print("studio: " + str(studio))
     #print("media_type: " + str(media_type))
 
-    print("year: " + start_year + " -- " + num_eps + " ep -- " + ep_length + " mins -- " + studio + " -- " + media_type)
+    if not args.quiet:
+        print("year: " + start_year + " -- " + num_eps + " ep -- " + ep_length + " mins -- " + studio + " -- " + media_type)
 
     anime_planet_info = {
         "start_year": start_year,
@@ -613,7 +2241,88 @@ def openTabs(name):
     anime_planet_url = "https://www.anime-planet.com/anime/all?name="+query
     webbrowser.open(anime_planet_url, new=2, autoraise=True)
 
-def getInitialCounts(data, root):
+# entries below this are converted in-process even with --workers
+SHARD_MIN_ENTRIES = 500
+
+def setShardEntries(entries):
+    global shard_entries
+    shard_entries = entries
+    # forked workers inherit the queue handler but not the thread writing it out
+    logger.handlers = [consoleHandler()]
+
+def classifyShard(task):
+    """Worker side of --workers, classifies a slice of entries and converts the cached ones.
+
+    Returns each entry's kind ('bad', 'cached' or 'not_found') and the converted
+    entries rendered for each of the given output formats, in order.
+    """
+    start, end, formats = task
+    records = []
+    kinds = []
+    for entry in shard_entries[start:end]:
+        name = entry['name']
+        if badSearch(name):
+            kinds.append('bad')
+            continue
+
+        foundID = cacheSearch(name)
+        if foundID != False:
+            kinds.append('cached')
+            record = entryRecord(entry, foundID)
+            if record:
+                records.append(record)
+            continue
+
+        kinds.append('not_found')
+
+    return kinds, renderRecords(records, formats)
+
+def shardedInitialCounts(data, output):
+    """Splits the entries across --workers processes and merges their results in order.
+
+    Workers read the mapping indexes they inherit (or load on platforms that
+    spawn), queue writes stay in this process.
+    """
+    entries = data['entries']
+    size = math.ceil(len(entries) / args.workers)
+    bounds = [(i, min(i + size, len(entries))) for i in range(0, len(entries), size)]
+
+    with multiprocessing.Pool(args.workers, initializer=setShardEntries, initargs=(entries,)) as pool:
+        results = pool.map(classifyShard, [(start, end, output.formats) for start, end in bounds])
+
+    cachedEntries = []
+    notFoundEntries = []
+    badEntries = []
+
+    for (start, end), (kinds, fragment) in zip(bounds, results):
+        for entry, kind in zip(entries[start:end], kinds):
+            name = entry['name']
+            if kind == 'bad':
+                badEntries.append(entry)
+                logger.error("Bad title -- "+name)
+            elif kind == 'cached':
+                cachedEntries.append(entry)
+            else:
+                notFoundEntries.append(entry)
+
+        output.addRendered(fragment)
+
+    queueUnmapped((entry['name'] for entry in notFoundEntries), data)
+
+    if not args.quiet:
+        flushLog()
+        print("=================================")
+        print("Total Entries: "+str(len(entries)))
+        print("Cache Found: "+str(len(cachedEntries)))
+        print("Bad Found: "+str(len(badEntries)))
+        print("Not Found: "+str(len(notFoundEntries)))
+
+    return (cachedEntries, notFoundEntries, badEntries)
+
+def getInitialCounts(data, output):
+    if args.workers > 1 and len(data['entries']) >= SHARD_MIN_ENTRIES:
+        return shardedInitialCounts(data, output)
+
     cacheFound = 0
     badFound = 0
     notFound = 0
@@ -638,25 +2347,25 @@ def getInitialCounts(data, root):
             cachedEntries.append(entry)
             logger.info('Cached ID found: ' + name + ' ---> ' + foundID)
             
-            convertEntry(entry, foundID, root)
+            convertEntry(entry, foundID, output)
             continue
         
         notFound += 1
         notFoundEntries.append(entry)
-        
-        unmappedEntry = unmappedCheck(name, args.unmapped_file)
-        if unmappedEntry == False:
-            unmapped(name, args.unmapped_file)
     
-    print("=================================")
-    print("Total Entries: "+str(len(data['entries'])))
-    print("Cache Found: "+str(cacheFound))
-    print("Bad Found: "+str(badFound))
-    print("Not Found: "+str(notFound))
+    queueUnmapped((entry['name'] for entry in notFoundEntries), data)
+
+    if not args.quiet:
+        flushLog()
+        print("=================================")
+        print("Total Entries: "+str(len(data['entries'])))
+        print("Cache Found: "+str(cacheFound))
+        print("Bad Found: "+str(badFound))
+        print("Not Found: "+str(notFound))
 
     return (cachedEntries, notFoundEntries, badEntries)
 
-def searchEntries(entries, root):
+def searchEntries(entries, output):
     count = 0
     found = 0
     notFound = 0
@@ -676,11 +2385,24 @@ def searchEntries(entries, root):
         if limit > -1 and count >= limit:
             break
 
+        if budgetExceeded():
+            break
+
         foundID = False
         count += 1
         
         name = entry['name']
-        foundID = search(name)
+
+        # an earlier entry (or another user's export in batch mode) may have resolved it already
+        foundID = cacheSearch(name)
+        if foundID != False:
+            found += 1
+            foundEntries.append(foundID)
+            if output is not None:
+                convertEntry(entry, foundID, output)
+            continue
+
+        foundID = coalescedSearch(name)
 
         if foundID == -1:
             logger.info("Quitting program...")
@@ -698,8 +2420,10 @@ def searchEntries(entries, root):
 
         foundEntries.append(foundID)
         cache(name, foundID)
+        removeUnmapped(name)
 
-        convertEntry(entry, foundID, root)
+        if output is not None:
+            convertEntry(entry, foundID, output)
 
         strlog = str(count) + ": " + name + " ---> " + foundID
         logger.info("Added to cache: "+strlog)
@@ -714,6 +2438,7 @@ def processConfirm():
         print("There is a search queue. Please use --search-queue to process the remaining unconfirmed entries. When the search queue is clear you can use --cache-only to generate your converted list.")
         return False
 
+    flushLog()
     answer = input("There is a search queue, would you like to process the queue now? (y/n): ")
     if answer.strip().lower() == "y":
         return True
@@ -722,7 +2447,8 @@ def processConfirm():
     logger.debug('ERROR: Bad input. Asking again.')
     return processConfirm()
 
-def convertEntry(i, foundID, root):
+def entryRecord(i, foundID):
+    """Converts an Anime Planet entry into the MAL list fields, False if it is skipped."""
     name = i['name']
 
     #Convert status
@@ -734,50 +2460,224 @@ def convertEntry(i, foundID, root):
     elif stat == 'dropped': stat = 'Dropped'
     elif stat == "won't watch": return False
 
-    #Populate anime XML entry
-    entry = ET.SubElement(root, 'anime')
-    malid = ET.SubElement(entry, 'series_animedb_id')
-    title = ET.SubElement(entry, 'series_title')
-    weps = ET.SubElement(entry, 'my_watched_episodes')
-    wsd = ET.SubElement(entry, 'my_start_date')
-    wfd = ET.SubElement(entry, 'my_finish_date')
-    score = ET.SubElement(entry, 'my_score')
-    status = ET.SubElement(entry, 'my_status')
-    twatched = ET.SubElement(entry, 'my_times_watched')
-
-    malid.text = foundID
-    title.text = name
-    status.text = stat
-    weps.text = str(i['eps'])
-
-    wsd.text = "0000-00-00"
-    wfd.text = "0000-00-00"
-    score.text = str(int(i['rating']*2))
-    twatched.text = "0"
+    record = {
+        'series_animedb_id': foundID,
+        'series_title': name,
+        'my_watched_episodes': str(i['eps']),
+        'my_start_date': "0000-00-00",
+        'my_finish_date': "0000-00-00",
+        'my_score': str(int(i['rating']*2)),
+        'my_status': stat,
+        'my_times_watched': "0",
+    }
 
     if str(i['started']) != "None": 
-        wsd.text = str(i['started']).split()[0]
+        record['my_start_date'] = str(i['started']).split()[0]
     
     if str(i['completed']) != "None":
-        wfd.text = str(i['completed']).split()[0]
+        record['my_finish_date'] = str(i['completed']).split()[0]
 
     # becomes num of rewatches on MAL, so subtract 1
     if (i['times'] > 1):
-        twatched.text = str(i['times']-1)
+        record['my_times_watched'] = str(i['times']-1)
+
+    return record
+
+def convertEntry(i, foundID, output):
+    record = entryRecord(i, foundID)
+    if record:
+        output.add(record)
+    return record
+
+def xmlEscape(text):
+    text = text.replace("&", "&amp;").replace("<", "&lt;")
+    return text.replace("\"", "&quot;").replace(">", "&gt;")
+
+def xmlElement(tag, text, indent):
+    if text:
+        return indent + '<' + tag + '>' + xmlEscape(text) + '</' + tag + '>\n'
+    return indent + '<' + tag + '/>\n'
+
+# entries stay in memory until this many characters, then spill to a temp file
+OUTPUT_SPOOL_SIZE = 4 * 1024 * 1024
+
+class OutputEmitter:
+    """Base for an output format, written once all entries have been rendered.
+
+    Entries are spooled as rendered text so headers that need the final total
+    can be written first, without keeping a document tree around.
+    """
+    separator = ''
+
+    def __init__(self, path=None, compress=False):
+        self.path = path
+        self.compress = compress
+        self.count = 0
+        self.spool = tempfile.SpooledTemporaryFile(max_size=OUTPUT_SPOOL_SIZE, mode='w+', encoding='utf-8')
+
+    def write(self, text):
+        if self.count > 0:
+            self.spool.write(self.separator)
+        self.spool.write(text)
+        self.count += 1
+
+    def close(self, user, total):
+        """Writes the output file, returns the text instead when there's no path."""
+        if self.path is None:
+            dest = io.StringIO()
+        elif self.compress:
+            dest = gzip.open(self.path, 'wt', encoding='utf-8', compresslevel=6)
+        else:
+            dest = open(self.path, 'w', encoding='utf-8')
+
+        try:
+            dest.write(self.header(user, total))
+            self.spool.seek(0)
+            shutil.copyfileobj(self.spool, dest)
+            dest.write(self.footer())
+            if self.path is None:
+                return dest.getvalue()
+            return self.path
+        finally:
+            self.spool.close()
+            dest.close()
+
+class XMLEmitter(OutputEmitter):
+    """MyAnimeList XML export format, as imported by AniList and MAL."""
+    extension = 'xml'
+
+    @staticmethod
+    def render(record):
+        text = '\t<anime>\n'
+        for tag, value in record.items():
+            text += xmlElement(tag, value, '\t\t')
+        return text + '\t</anime>\n'
+
+    def header(self, user, total):
+        return ('<?xml version="1.0" ?>\n<myanimelist>\n\t<myinfo>\n'
+            + xmlElement('user_name', user, '\t\t')
+            + xmlElement('user_total_anime', str(total), '\t\t')
+            + '\t</myinfo>\n')
+
+    def footer(self):
+        return '</myanimelist>\n'
+
+# MAL statuses under their AniList names
+ANILIST_STATUSES = {
+    'Completed': 'COMPLETED',
+    'Watching': 'CURRENT',
+    'Plan to Watch': 'PLANNING',
+    'On-Hold': 'PAUSED',
+    'Dropped': 'DROPPED',
+}
 
+def anilistDate(value):
+    year, month, day = (int(part) for part in value.split('-'))
+    if year == 0:
+        return None
+    return {"year": year, "month": month or None, "day": day or None}
+
+class AniListEmitter(OutputEmitter):
+    """JSON list entries shaped like AniList's SaveMediaListEntry fields, scores out of 10."""
+    extension = 'json'
+    separator = ',\n'
+
+    @staticmethod
+    def render(record):
+        return jsonDumps({
+            "mediaIdMal": int(record['series_animedb_id']),
+            "title": record['series_title'],
+            "status": ANILIST_STATUSES.get(record['my_status'], 'PLANNING'),
+            "progress": int(record['my_watched_episodes']) if record['my_watched_episodes'].isdigit() else 0,
+            "score": int(record['my_score']),
+            "repeat": int(record['my_times_watched']),
+            "startedAt": anilistDate(record['my_start_date']),
+            "completedAt": anilistDate(record['my_finish_date']),
+        })
+
+    def header(self, user, total):
+        return '{"user":' + jsonDumps(user) + ',"total":' + str(total) + ',"entries":[\n'
+
+    def footer(self):
+        return '\n]}\n'
+
+OUTPUT_EMITTERS = {
+    'xml': XMLEmitter,
+    'json': AniListEmitter,
+}
 
-def processList():
-    data = loadJSON(args.anime_list)
+def outputTargets(output_file=None):
+    """Returns (format, path, compress) for every --output, paths default next to output_file.
+
+    Formats are xml or json, a .gz suffix on the format or path compresses it.
+    Batch runs always derive the paths from each user's output file.
+    """
+    if output_file is None:
+        output_file = args.output_file
+    base = output_file
+    if base.endswith('.xml'):
+        base = base[:-len('.xml')]
+
+    targets = []
+    for spec in args.output or ['xml:' + output_file]:
+        fmt, _, path = spec.partition(':')
+        if args.batch:
+            path = ''
+        compress = fmt.endswith('.gz')
+        fmt = fmt[:-len('.gz')] if compress else fmt
+        if path == '':
+            path = base + '.' + OUTPUT_EMITTERS[fmt].extension + ('.gz' if compress else '')
+        compress = compress or path.endswith('.gz')
+        targets.append((fmt, path, compress))
+    return targets
+
+def renderRecords(records, formats):
+    """Renders records for each output format, used by --workers processes."""
+    return [[OUTPUT_EMITTERS[fmt].render(record) for record in records] for fmt in formats]
+
+class OutputStage:
+    """Streams converted entries to every output format in one pass."""
+
+    def __init__(self, user, targets):
+        self.user = user
+        self.formats = [fmt for fmt, path, compress in targets]
+        self.emitters = [OUTPUT_EMITTERS[fmt](path, compress) for fmt, path, compress in targets]
+
+    def add(self, record):
+        for emitter in self.emitters:
+            emitter.write(emitter.render(record))
+
+    def addRendered(self, rendered):
+        """Adds entries already rendered by renderRecords() for self.formats."""
+        for emitter, texts in zip(self.emitters, rendered):
+            for text in texts:
+                emitter.write(text)
+
+    def close(self, total):
+        return [emitter.close(self.user, total) for emitter in self.emitters]
+
+def newOutput(data, output_file=None):
+    return OutputStage(data['user']['name'], outputTargets(output_file))
+
+def logSummary(totalCount, cacheFound, badFound, searchFound, notFound):
+    flushLog()
+    print("=================================")
+    logger.info("Total Entries: "+str(totalCount), extra=SUMMARY)
+    logger.info("Cache Found: "+str(cacheFound), extra=SUMMARY)
+    logger.info("Bad Found: "+str(badFound), extra=SUMMARY)
+    logger.info("Search Found: "+str(searchFound), extra=SUMMARY)
+    logger.info("Not Found: "+str(notFound), extra=SUMMARY)
 
-    #Start MAL XML structure
-    root = ET.Element('myanimelist')
-    info = ET.SubElement(root, 'myinfo')
-    uname = ET.SubElement(info, 'user_name')
-    total = ET.SubElement(info, 'user_total_anime')
-    uname.text = data['user']['name']
+def processList(anime_list=None, output_file=None):
+    if anime_list is None:
+        anime_list = args.anime_list
+    if output_file is None:
+        output_file = args.output_file
 
+    data = loadJSON(anime_list)
+    output = newOutput(data, output_file)
 
-    cachedEntries, notFoundEntries, badEntries = getInitialCounts(data, root)
+    cachedEntries, notFoundEntries, badEntries = getInitialCounts(data, output)
 
     skipSearch = False
     if len(notFoundEntries) <= 0:
@@ -790,76 +2690,525 @@ def processList():
     foundEntries = []
 
     if skipSearch == False:
-        foundEntries = searchEntries(notFoundEntries, root)
+        foundEntries = searchEntries(notFoundEntries, output)
 
     totalCount = len(data['entries'])
     cacheFound = len(cachedEntries)
     badFound = len(badEntries)
     searchFound = len(foundEntries)
-    notFound = len(notFoundEntries)
+    notFound = len(notFoundEntries) - searchFound
+
+    #Export converted list in every output format
+    output.close(cacheFound + searchFound)
+    logSummary(totalCount, cacheFound, badFound, searchFound, notFound)
+
+def planTitle(name):
+    """Returns how a title would be settled, without network calls or writing anything.
+
+    Follows the order of resolverChain(), returns 'bad', 'cached', 'too_short',
+    'alias', 'confirm', 'store', 'negative', 'suggestion', 'recorded',
+    'franchise_confirm' or 'remote'.
+    Franchise matches only count related entries already stored.
+    """
+    if badSearch(name):
+        return 'bad'
+    if cacheSearch(name):
+        return 'cached'
+    if len(name) < 3:
+        return 'too_short'
+
+    if args.aliases:
+        if alias_index is None:
+            loadAliases()
+        if alias_index.get(aliasKey(name)):
+            return 'alias'
+        if not args.skip_confirm and lossy_alias_index.get(lossyAliasKey(name)):
+            return 'confirm'
+
+    if store_index is None:
+        loadStoreIndex(write=False)
+    if store_index.get(name.casefold()):
+        return 'store'
+    if negativeCheck(name):
+        return 'negative'
+    if name in suggestion_index:
+        return 'suggestion'
+    if args.candidates_file and cachedResponse(name):
+        return 'recorded'
+    if args.franchise and not args.skip_confirm:
+        options = franchiseMatch(name, False)
+        if options and options[0].score >= FRANCHISE_CONFIRM:
+            return 'franchise_confirm'
+    return 'remote'
+
+def planSearchCalls():
+    """Returns the fewest and most API calls a remote search makes, per provider."""
+    provider = searchProvider()
+    if provider == 'jikan':
+        return {'jikan': (1, 1)}
+    # details come with the search when results are compared or shown, Jikan follows when MAL finds nothing
+    calls = {'mal': (1, 1)}
+    if not hedgeEnabled():
+        calls['jikan'] = (0, 1)
+    return calls
+
+def formatDuration(seconds):
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+def formatSize(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return str(round(size, 1)) + " " + unit
+        size /= 1024
+
+def planOutputSize(records, missing, targets):
+    """Estimates each output file's size, counting the missing entries as found."""
+    sizes = []
+    for fmt, path, compress in targets:
+        emitter = OUTPUT_EMITTERS[fmt]
+        rendered = [emitter.render(record).encode('utf-8') for record in records]
+        size = sum(len(text) for text in rendered)
+        if rendered:
+            size += round(size / len(rendered) * missing)
+        size += len(emitter(None).header('user', len(records) + missing)) + len(emitter(None).footer())
+        if compress and rendered:
+            sample = b''.join(rendered)
+            size = round(size * len(gzip.compress(sample, compresslevel=6)) / len(sample))
+        sizes.append((path, size))
+    return sizes
+
+def plan():
+    """Reports what a run would do: how titles resolve, API calls, runtime and output size."""
+    if args.search_queue:
+        sources = [(None, [{'name': row[0]} for row in queueRows(processCacheFiles(args.unmapped_file))])]
+    else:
+        files = batchFiles(args.batch) if args.batch else [args.anime_list]
+        sources = [(anime_list, loadJSON(anime_list)) for anime_list in files]
+
+    counts = {}
+    titles = {}
+    sizes = []
+    used = set()
+    for anime_list, data in sources:
+        entries = data if anime_list is None else data['entries']
+        records = []
+        missing = 0
+        for entry in entries:
+            name = entry['name']
+            kind = planTitle(name)
+            counts[kind] = counts.get(kind, 0) + 1
+            if kind in ('remote', 'confirm', 'franchise_confirm'):
+                titles.setdefault(normalizeTitle(name), kind)
+
+            if anime_list is None:
+                continue
+            foundID = cacheSearch(name)
+            if kind == 'alias':
+                foundID = alias_index[aliasKey(name)][1]
+            elif kind == 'store':
+                foundID = store_index[name.casefold()]
+            if foundID:
+                record = entryRecord(entry, foundID)
+                if record:
+                    records.append(record)
+            elif kind in ('remote', 'confirm', 'franchise_confirm', 'suggestion', 'recorded'):
+                missing += 1
+
+        if anime_list is not None:
+            output_file = batchOutputFile(data, used) if args.batch else args.output_file
+            sizes += planOutputSize(records, missing, outputTargets(output_file))
+
+    searches = [kind for kind in titles.values() if kind == 'remote']
+    if args.limit > -1:
+        searches = searches[:args.limit]
+
+    calls = {}
+    for provider, (fewest, most) in planSearchCalls().items():
+        calls[provider] = (fewest * len(searches), most * len(searches))
+    mostCalls = sum(most for fewest, most in calls.values())
+
+    flushLog()
+    print("=================================")
+    logger.info("Total Entries: " + str(sum(counts.values())), extra=SUMMARY)
+    labels = [('cached', "Cache Found"), ('bad', "Bad Found"), ('alias', "Alias Matches"), ('store', "MAL Store Matches"),
+        ('suggestion', "Saved Suggestions"), ('recorded', "Recorded Search Results"), ('negative', "Skipped (searched before)"), ('too_short', "Too Short"),
+        ('confirm', "Alias Confirmations"), ('franchise_confirm', "Franchise Confirmations"), ('remote', "Remote Lookups")]
+    for kind, label in labels:
+        logger.info(label + ": " + str(counts.get(kind, 0)), extra=SUMMARY)
 
-    total.text = str(cacheFound + searchFound)
+    print("=================================")
+    logger.info("Unique Searches: " + str(len(searches)), extra=SUMMARY)
+    for provider, (fewest, most) in calls.items():
+        callRange = str(fewest) if fewest == most else str(fewest) + " - " + str(most)
+        logger.info(provider + " API calls: " + callRange, extra=SUMMARY)
+    if hedgeEnabled():
+        logger.info("Hedged searches can add calls to the other API", extra=SUMMARY)
+
+    # every call to a provider waits --api-delay after the one before it
+    seconds = mostCalls * args.api_delay
+    logger.info("Estimated Time: " + formatDuration(seconds), extra=SUMMARY)
+    if not args.skip_confirm and len(searches) > 0:
+        logger.info("Plus manual confirmation of titles without a confident match", extra=SUMMARY)
+    if args.max_api_calls > 0 and mostCalls > args.max_api_calls:
+        logger.info("Runs with --max-api-calls " + str(args.max_api_calls) + ": " + str(math.ceil(mostCalls / args.max_api_calls)), extra=SUMMARY)
+    if args.max_runtime > 0 and seconds > args.max_runtime * 60:
+        logger.info("Runs with --max-runtime " + str(args.max_runtime) + ": " + str(math.ceil(seconds / (args.max_runtime * 60))), extra=SUMMARY)
+
+    for path, size in sizes:
+        logger.info("Output " + path + ": ~" + formatSize(size), extra=SUMMARY)
+
+def batchFiles(batch):
+    """Returns the export paths of a batch directory or manifest file."""
+    if os.path.isdir(batch):
+        files = []
+        for fname in sorted(os.listdir(batch)):
+            if fname.lower().endswith('.json'):
+                files.append(os.path.join(batch, fname))
+        return files
+
+    files = []
+    base = os.path.dirname(batch)
+    with open(batch, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            files.append(os.path.join(base, line))
+    return files
+
+def batchOutputFile(data, used):
+    """Picks a per-user output path inside the output folder."""
+    name = str(data['user']['name'])
+    name = "".join(c if c.isalnum() or c in '-_' else '_' for c in name)
+    fname = 'convert_' + name
+    output_file = os.path.join(args.output_dir, fname + '.xml')
+    n = 2
+    while output_file in used:
+        output_file = os.path.join(args.output_dir, fname + '_' + str(n) + '.xml')
+        n += 1
+    used.add(output_file)
+    return output_file
+
+def processBatch():
+    """Converts several exports in one process.
+
+    Every user is classified against the shared in-memory mappings first, then the
+    titles still missing are searched once across all users before each user's
+    file is written.
+    """
+    files = batchFiles(args.batch)
+    if len(files) == 0:
+        logger.error("No exports found for batch: " + str(args.batch))
+        return
 
-    #Export XML to convert file
-    #tree = ET.ElementTree(root)
-    dom = minidom.parseString(ET.tostring(root))
-    dom = dom.toprettyxml(indent='\t')
-    with open('convert.xml', 'w', encoding='utf-8') as f2:
-        f2.write(dom)
-    
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    users = []
+    used = set()
+    queue = {}
+    for anime_list in files:
+        print()
+        print("[BATCH] " + anime_list)
+        data = loadJSON(anime_list)
+        output_file = batchOutputFile(data, used)
+        output = newOutput(data, output_file)
+        cachedEntries, notFoundEntries, badEntries = getInitialCounts(data, output)
+        users.append((anime_list, data, output, output_file, cachedEntries, notFoundEntries, badEntries))
+
+        for entry in notFoundEntries:
+            queue.setdefault(entry['name'], entry)
+
+    flushLog()
     print("=================================")
-    logger.info("Total Entries: "+str(totalCount))
-    logger.info("Cache Found: "+str(cacheFound))
-    logger.info("Bad Found: "+str(badFound))
-    logger.info("Search Found: "+str(searchFound))
-    logger.info("Not Found: "+str(notFound))
-
-def unmapped(name, unmapped_file):
-    with open(unmapped_file, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
-        writer.writerow([name])
+    print("Unique titles to search: " + str(len(queue)))
 
-def removeUnmapped(name):
-    with open(args.unmapped_file, newline='', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        data = list(reader)
+    if len(queue) > 0 and not args.cache_only and processConfirm():
+        searchEntries(list(queue.values()), None)
 
-    row = False
-    rowNum = 0
-    for i in data:
-        if i[0] == name:
-            row = rowNum
-            break
-        rowNum += 1
+    for anime_list, data, output, output_file, cachedEntries, notFoundEntries, badEntries in users:
+        searchFound = 0
+        for entry in notFoundEntries:
+            foundID = cacheSearch(entry['name'])
+            if foundID != False:
+                searchFound += 1
+                convertEntry(entry, foundID, output)
 
-    newRows = data[:row] + data[row+1:]
+        paths = output.close(len(cachedEntries) + searchFound)
 
-    with open(args.unmapped_file, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
-        writer.writerows(newRows)
+        print()
+        logger.info("[BATCH] " + anime_list + " ---> " + ", ".join(paths), extra=SUMMARY)
+        logSummary(len(data['entries']), len(cachedEntries), len(badEntries), searchFound, len(notFoundEntries) - searchFound)
+
+def queueUnmapped(names, data):
+    """Queues the titles an export couldn't map, counting the export once per title.
+
+    Running the same export (or another export of the same user) again doesn't
+    add demand. New demand is appended, the queue is re-read under its lock so
+    changes by other workers are kept.
+    """
+    global unmapped_index
+    names = list(dict.fromkeys(names))
+    if len(names) == 0:
+        return
+    key = exportKey(data)
+
+    with fileLock(args.unmapped_file):
+        queue, exports = demandRows(processCacheFiles(args.unmapped_file))
+        newRows = []
+        for name in names:
+            if key in exports.get(name, ()):
+                continue
+            name = sys.intern(name)
+            queue[name] = queue.get(name, 0) + 1
+            newRows.append([name, 1, key])
+
+        if newRows:
+            appendRows(args.unmapped_file, newRows)
+            ownMappingWrite(args.unmapped_file)
+        unmapped_index = queue
 
-def unmappedCheck(name, unmapped_file):
-    with open(unmapped_file, newline='', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        data = list(reader)
+def removeUnmapped(name):
+    global unmapped_index
+    with fileLock(args.unmapped_file):
+        rows = [row for row in processCacheFiles(args.unmapped_file) if row]
+        kept = [row for row in rows if row[0] != name]
+        if len(kept) < len(rows):
+            writeMappingRows(args.unmapped_file, kept)
+            ownMappingWrite(args.unmapped_file)
+        unmapped_index = demandIndex(kept)
+
+def mappingSortKey(row):
+    return (row[0].casefold(), row[0])
+
+def writeMappingRows(file, rows):
+    """Replaces a mapping file in one step so readers never see it half written."""
+    tmp_file = tmpName(file)
+    with open(tmp_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerows(rows)
+    os.replace(tmp_file, file)
+
+# mangatransfer.py's mapping files, compacted and benchmarked from here
+MANGA_CACHE_FILE = 'mappings/manga_cache.csv'
+MANGA_BAD_FILE = 'mappings/manga_bad.csv'
+
+def compactCacheRows(cache_file, bad_file):
+    """Deduplicates a cache and bad file pair, returns the kept rows and the conflict count.
+
+    The first cache row of a title is kept, the one lookups use. Titles both
+    cached and marked bad are kept in both files and reported, picking a side
+    is left to the user.
+    """
+    badRows = processCacheFiles(bad_file)
+    bad = {}
+    for row in badRows:
+        if row:
+            bad.setdefault(row[0], row[:1])
+
+    cacheRows = processCacheFiles(cache_file)
+    cached = {}
+    conflicts = 0
+    for row in cacheRows:
+        if not row:
+            continue
+        if row[0] in cached:
+            if cached[row[0]][1] != row[1]:
+                conflicts += 1
+                logger.warning("Conflicting mapping dropped: " + row[0] + " ---> " + row[1] + " (kept " + cached[row[0]][1] + ")")
+            continue
+        cached[row[0]] = row[:2]
+
+    for title in cached:
+        if title in bad:
+            conflicts += 1
+            logger.warning("Title is both mapped and marked bad, kept in both: " + title + " ---> " + cached[title][1])
+
+    report = [
+        (cache_file, len(cacheRows), sorted(cached.values(), key=mappingSortKey)),
+        (bad_file, len(badRows), sorted(bad.values(), key=mappingSortKey)),
+    ]
+    return cached, bad, report, conflicts
+
+def compactMappings():
+    """Deduplicates the anime and manga mapping files, drops queued titles already settled and sorts them.
+
+    Lookups check the bad list before the cache and use the first cache row for
+    a title, so compaction keeps exactly what lookups already returned.
+    """
+    with fileLock(args.cache_file), fileLock(args.bad_file), fileLock(args.unmapped_file), fileLock(args.negative_file):
+        cached, bad, report, conflicts = compactCacheRows(args.cache_file, args.bad_file)
+
+        unmappedRows = processCacheFiles(args.unmapped_file)
+        queue, exports = demandRows(unmappedRows)
+        unmappedTitles = []
+        for title, demand in queue.items():
+            if title in cached or title in bad:
+                continue
+            # older counts stay one row, every counted export keeps its own row
+            counted = sorted(exports.get(title, ()))
+            if demand > len(counted):
+                unmappedTitles.append([title, str(demand - len(counted))])
+            unmappedTitles += [[title, '1', key] for key in counted]
+        report.append((args.unmapped_file, len(unmappedRows), sorted(unmappedTitles, key=mappingSortKey)))
+
+        if os.path.isfile(args.negative_file):
+            negativeRows = processCacheFiles(args.negative_file)
+            # the last row for a title is the current state, see loadNegative()
+            negatives = {}
+            for row in negativeRows:
+                if len(row) >= 3 and row[0] not in cached and row[0] not in bad:
+                    negatives.pop(row[0], None)
+                    negatives[row[0]] = row
+            report.append((args.negative_file, len(negativeRows), sorted(negatives.values(), key=mappingSortKey)))
+
+        if os.path.isfile(MANGA_CACHE_FILE) and os.path.isfile(MANGA_BAD_FILE):
+            mangaCached, mangaBad, mangaReport, mangaConflicts = compactCacheRows(MANGA_CACHE_FILE, MANGA_BAD_FILE)
+            report += mangaReport
+            conflicts += mangaConflicts
+
+        flushLog()
+        print("=================================")
+        for file, before, rows in report:
+            writeMappingRows(file, rows)
+            logger.info(file + ": " + str(before) + " -> " + str(len(rows)) + " rows", extra=SUMMARY)
+        logger.info("Conflicts (see warnings): " + str(conflicts), extra=SUMMARY)
+
+        loadMappings()
+        loadNegative()
+
+# titles of extras that are rarely listed on MAL under the same name
+EXTRA_TITLE = re.compile(r'\b(recap|special|picture drama|cm|pv|promotional)\b')
+
+def queuePriority(row):
+    """Scores how likely a queued title is to be found by a search, higher first.
+
+    Titles wanted by more exports, longer (more specific) titles and titles
+    with a mapped near-miss rank up, earlier failed searches and extras rank down.
+    """
+    name = row[0]
+    demand = int(row[1]) if len(row) > 1 and row[1].isdigit() else 1
+    score = math.log2(1 + demand)
+    score += min(len(name), 40) / 40
+
+    if args.aliases and lossy_alias_index.get(lossyAliasKey(name)):
+        score += 1
+    if name in negative_index:
+        score -= negative_index[name][2]
+    if EXTRA_TITLE.search(aliasKey(name)):
+        score -= 0.5
+    return score
+
+def queueRows(rows):
+    """Returns the search queue rows in the order they should be searched, one per title with its demand."""
+    rows = [[title, str(demand)] for title, demand in demandIndex(rows).items()]
+    if args.queue_order == 'file':
+        return rows
+    if args.aliases and alias_index is None:
+        loadAliases()
+    # --offset skips rows in file order, so resuming skips the same titles however their priorities changed
+    return rows[:args.offset] + sorted(rows[args.offset:], key=queuePriority, reverse=True)
+
+def leasePath(name):
+    lease_dir = os.path.join(os.path.dirname(args.unmapped_file), 'leases')
+    os.makedirs(lease_dir, exist_ok=True)
+    return os.path.join(lease_dir, hashlib.sha1(name.encode('utf-8')).hexdigest() + '.lease')
+
+def leaseOwner(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+# leases this worker holds, kept fresh by renewLeases() while their search or prompt is open
+held_leases = set()
+lease_keeper = None
+
+def renewLeases():
+    while True:
+        time.sleep(max(1, args.lease_ttl / 3))
+        for path in list(held_leases):
+            if leaseOwner(path) == args.worker_id:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+
+def holdLease(path):
+    global lease_keeper
+    held_leases.add(path)
+    if lease_keeper is None:
+        lease_keeper = threading.Thread(target=renewLeases, daemon=True)
+        lease_keeper.start()
+
+def claimTitle(name):
+    """Claims a queued title for this worker, False if another worker holds a live lease.
+
+    Leases are renewed while held, so one older than --lease-ttl belongs to a
+    worker that stopped. It is moved aside like a stale lock and claimed again
+    with O_EXCL, so only one of several workers taking it over gets it.
+    """
+    path = leasePath(name)
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, args.worker_id.encode('utf-8'))
+            os.close(fd)
+            holdLease(path)
+            return True
+        except FileExistsError:
+            pass
 
-    for i in data:
-        if i[0] == name:
+        owner = leaseOwner(path)
+        if owner is None:
+            continue
+        if owner == args.worker_id:
+            holdLease(path)
             return True
-        
-    return False
+        try:
+            if time.time() - os.path.getmtime(path) < args.lease_ttl:
+                return False
+        except FileNotFoundError:
+            continue
+        breakStaleLock(path, owner)
+
+def releaseTitle(name):
+    path = leasePath(name)
+    held_leases.discard(path)
+    if leaseOwner(path) == args.worker_id:
+        os.remove(path)
+
+def queueSearch(name):
+    """Searches a queued title unless another worker claimed or mapped it.
+
+    Returns the MAL ID, False, -1 to quit or None when another worker has it.
+    Unless None is returned the lease is still held, the caller releases it
+    once the result is saved.
+    """
+    if not claimTitle(name):
+        logger.info("Claimed by another worker, skipping -- " + name)
+        return None
+    try:
+        syncMappings()
+        if badSearch(name):
+            logger.info("Marked bad by another worker -- " + name)
+            removeUnmapped(name)
+            releaseTitle(name)
+            return None
+        return coalescedSearch(name)
+    except BaseException:
+        releaseTitle(name)
+        raise
 
 def searchQueue():
-    with open(args.unmapped_file, newline='', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        data = list(reader)
+    data = queueRows(processCacheFiles(args.unmapped_file))
 
     queueTotal = len(data)
 
     count = 0
     foundEntries = []
     #notFoundEntries = []
-    print("PROGRESS: " + str(count) + " / " + str(queueTotal))
+    progress(count, queueTotal)
     for name in data:
         if count < args.offset:
             count += 1
@@ -870,12 +3219,23 @@ def searchQueue():
         if limit > -1 and count >= limit:
             break
 
+        if budgetExceeded():
+            break
+
         name = name[0]
 
         foundID = False
         count += 1
         
-        foundID = search(name)
+        foundID = queueSearch(name)
+        if foundID is None:
+            continue
+        try:
+            if foundID != False and foundID != -1:
+                cache(name, foundID)
+                removeUnmapped(name)
+        finally:
+            releaseTitle(name)
 
         if foundID == -1:
             logger.info("Quitting program...")
@@ -887,20 +3247,18 @@ def searchQueue():
             #MUST use 4 second delay for Jikan API rate limits
             #delayCheck(args.api_delay)
             if args.skip_confirm == False:
-                os.system('clear')
-            print("PROGRESS: " + str(count) + " / " + str(queueTotal))
+                clearScreen()
+            progress(count, queueTotal)
             continue
 
         foundEntries.append(foundID)
-        cache(name, foundID)
-        removeUnmapped(name)
 
         if args.skip_confirm == False:
-            os.system('clear')
+            clearScreen()
 
         strlog = name + " ---> " + foundID
         logger.info("Added to cache: "+strlog)
-        print("PROGRESS: " + str(count) + " / " + str(queueTotal))
+        progress(count, queueTotal)
 
         #MUST use 4 second delay for Jikan API rate limits
         #delayCheck(args.api_delay)
@@ -909,9 +3267,10 @@ def searchQueue():
     searchFound = len(foundEntries)
     notFound = queueTotal
 
+    flushLog()
     print("=================================")
-    logger.info("Search Found: "+str(searchFound))
-    logger.info("Not Found: "+str(notFound))
+    logger.info("Search Found: "+str(searchFound), extra=SUMMARY)
+    logger.info("Not Found: "+str(notFound), extra=SUMMARY)
 
 def cache_verify():
     count = 1
@@ -925,6 +3284,8 @@ def cache_verify():
     
     needs_check = 0
     for cache_info in cache_data:
+        if budgetExceeded():
+            break
         #print("[ "+str(count) + " / " + str(full_cache_size)+" ]")
         ap_title = cache_info[0]
         mal_id = cache_info[1]
@@ -970,19 +3331,24 @@ def get_mal_data_by_id(mal_id):
     try:
         headers = {'X-MAL-CLIENT-ID': MAL_CLIENT_ID}
         query = urllib.parse.quote_plus(str(mal_id))
-        fields = "id,title,alternative_titles,start_date,end_date,media_type,num_episodes,start_season,source,average_episode_duration,studios"
-        url = "https://api.myanimelist.net/v2/anime/" + query + "?fields="+fields + "&nsfw=true"
-        mal = requests.get(url, headers=headers, timeout=6)
+        url = "https://api.myanimelist.net/v2/anime/" + query + "?fields="+MAL_DETAIL_FIELDS + "&nsfw=true"
+        mal = apiGet(url, headers=headers)
         # print("Status Code: "+str(mal.status_code))
         if mal.status_code != 200:
             logger.error("MAL API Error: "+str(mal.status_code)+" --- ID: " + mal_id)
             return False
-        malFile = mal.json()
+        malData = jsonLoads(mal.content)
+    except BudgetExceeded:
+        return False
+    except requests.Timeout:
+        logger.error("MAL request timed out -- ID: " + mal_id)
+        return False
     except:
         logger.error("MAL request failed -- ID: " + mal_id)
         return False
 
-    malData = json.loads(json.dumps(malFile))
+    mal_store_save(malData)
+
     #print(malData)
 
     return malData
@@ -1002,6 +3368,8 @@ def mal_api_store():
         count = args.offset + 1
     
     for cache_info in cache_data:
+        if budgetExceeded():
+            break
         #print("[MAL Cache]: "+str(count) + " / " + str(full_cache_size))
         ap_title = cache_info[0]
         mal_id = cache_info[1]
@@ -1014,25 +3382,313 @@ def mal_api_store():
         else:
             print(ap_title)
             mal_data = get_mal_data_by_id(mal_id)
-            if mal_data:
-                mal_api_json_cache(mal_data)
+            # get_mal_data_by_id() stores what it fetches
+            if mal_data and mal_store_check_by_id(mal_id):
+                print("Caching MAL data: " + mal_data['title'] + " --> " + str(mal_id)+'.json')
 
         print(flush=True)
         count += 1
         #delayCheck(args.api_delay)
         time.sleep(2.0)
 
-def mal_api_json_cache(data):
-    mal_id = data['id']
-    fname = 'mal_store/'+str(mal_id)+'.json'
+mal_store_lock = threading.Lock()
+
+MAL_STORE_INDEX = 'mal_store/index.csv'
 
-    if mal_store_check_by_fname(fname):
+# casefolded MAL title -> MAL ID, None when several entries share the title
+store_index = None
+
+def storeTitles(entry):
+    titles = [entry['title']]
+    altTitles = entry.get('alternative_titles') or {}
+    if altTitles.get('en'):
+        titles.append(altTitles['en'])
+    titles.extend(altTitles.get('synonyms') or [])
+    return list(dict.fromkeys(titles))
+
+def storeIndexAdd(title, mal_id):
+    key = sys.intern(title.casefold())
+    known = store_index.get(key, False)
+    if known is False:
+        store_index[key] = mal_id
+    elif known != mal_id:
+        store_index[key] = None
+
+def storeIndexFiles(store='mal_store'):
+    if not os.path.isdir(store):
+        return []
+    return [entry.path for entry in os.scandir(store) if entry.name.endswith('.json') and entry.name[:-5].isdigit()]
+
+def rebuildStoreIndex(store='mal_store', write=True):
+    """Rewrites the title index from the entries of a store, or only returns its rows if not write."""
+    rows = []
+    for fname in storeIndexFiles(store):
+        entry = loadJSON(fname)
+        for title in storeTitles(entry):
+            rows.append([title, str(entry['id'])])
+    if not write:
+        return rows
+
+    index_file = store + '/index.csv'
+    tmp_file = tmpName(index_file)
+    with open(tmp_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerows(rows)
+    os.replace(tmp_file, index_file)
+    # replacing the file touched the folder, the index has to stay the newer one
+    os.utime(index_file)
+    logger.info("Indexed " + str(len(rows)) + " titles in " + store)
+    return rows
+
+def loadStoreIndex(write=True):
+    """Loads the title index of the MAL store, rebuilding it if store files were added without it.
+
+    With write False an outdated index is rebuilt in memory only.
+    """
+    global store_index
+    store_index = {}
+    if not os.path.isdir('mal_store'):
         return
 
-    with open(fname, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-    
-    print("Caching MAL data: " + data['title'] + " --> " + str(mal_id)+'.json')
+    if os.path.isfile(MAL_STORE_INDEX) and os.path.getmtime(MAL_STORE_INDEX) >= os.path.getmtime('mal_store'):
+        rows = processCacheFiles(MAL_STORE_INDEX)
+    else:
+        rows = rebuildStoreIndex(write=write)
+
+    for row in rows:
+        if len(row) == 2:
+            storeIndexAdd(row[0], row[1])
+
+def storeIndexAppend(entry):
+    """Adds a new store entry's titles to the index file and the loaded index."""
+    mal_id = str(entry['id'])
+    titles = storeTitles(entry)
+    with fileLock(MAL_STORE_INDEX):
+        appendRows(MAL_STORE_INDEX, [[title, mal_id] for title in titles])
+    if store_index is not None:
+        for title in titles:
+            storeIndexAdd(title, mal_id)
+
+def storeSearch(name):
+    """Returns the MAL ID of the store entry with exactly this title, like an exact search match."""
+    if store_index is None:
+        loadStoreIndex()
+
+    mal_id = store_index.get(name.casefold())
+    if mal_id:
+        logger.info("MAL store match found: " + mal_id)
+        return mal_id
+    return False
+
+def mal_store_save(entry):
+    """Keeps a search result in the MAL store, returns True if it was added.
+
+    Only entries with the detail fields are kept, title-only search results
+    would hide the missing details from later lookups. Stored entries are
+    never replaced here, see refreshStore().
+    """
+    if 'media_type' not in entry and 'num_episodes' not in entry:
+        return False
+    entry.setdefault('_fetched_at', datetime.datetime.now().isoformat(timespec='seconds'))
+
+    mal_id = str(entry['id'])
+    fname = 'mal_store/'+mal_id+'.json'
+    with mal_store_lock:
+        if mal_store_check_by_fname(fname):
+            return False
+        os.makedirs('mal_store', exist_ok=True)
+        if store_index is None:
+            loadStoreIndex()
+        tmp_file = tmpName(fname)
+        saveJSON(entry, tmp_file)
+        os.replace(tmp_file, fname)
+        mal_store_memory[mal_id] = entry
+        storeIndexAppend(entry)
+    return True
+
+MANGA_STORE = 'mal_store/manga'
+
+# Jikan manga statuses under their MAL names
+JIKAN_MANGA_STATUSES = {
+    'Publishing': 'currently_publishing',
+    'Finished': 'finished',
+    'On Hiatus': 'on_hiatus',
+    'Discontinued': 'discontinued',
+    'Upcoming': 'not_yet_published',
+}
+
+def jikanMangaToMal(entry):
+    """Converts a Jikan manga entry into the MAL API fields kept in the manga store."""
+    malEntry = {
+        "id": entry['mal_id'],
+        "title": entry['title'],
+        "alternative_titles": {
+            "synonyms": entry.get('title_synonyms') or [],
+            "en": entry.get('title_english') or "",
+            "ja": entry.get('title_japanese') or "",
+        },
+    }
+
+    published = entry.get('published') or {}
+    if published.get('from'):
+        malEntry['start_date'] = published['from'].split('T')[0]
+    if published.get('to'):
+        malEntry['end_date'] = published['to'].split('T')[0]
+    if entry.get('type'):
+        malEntry['media_type'] = entry['type'].lower().replace(' ', '_')
+    if entry.get('status') in JIKAN_MANGA_STATUSES:
+        malEntry['status'] = JIKAN_MANGA_STATUSES[entry['status']]
+    if entry.get('chapters') is not None:
+        malEntry['num_chapters'] = entry['chapters']
+    if entry.get('volumes') is not None:
+        malEntry['num_volumes'] = entry['volumes']
+    return malEntry
+
+# CSV dump columns holding numbers, synonyms are separated by |
+DUMP_NUMBER_FIELDS = ('id', 'num_episodes', 'num_chapters', 'num_volumes', 'average_episode_duration')
+DUMP_CSV_FIELDS = ('start_date', 'end_date', 'media_type', 'source', 'status')
+
+def csvDumpEntry(row):
+    entry = {
+        "title": row.get('title', ''),
+        "alternative_titles": {
+            "synonyms": [title for title in (row.get('synonyms') or '').split('|') if title],
+            "en": row.get('en') or row.get('title_english') or "",
+        },
+    }
+    for field in DUMP_NUMBER_FIELDS:
+        if (row.get(field) or '').isdigit():
+            entry[field] = int(row[field])
+    for field in DUMP_CSV_FIELDS:
+        if row.get(field):
+            entry[field] = row[field]
+    if row.get('kind'):
+        entry['kind'] = row['kind']
+    return entry
+
+def dumpEntry(entry):
+    """Returns ('anime' or 'manga', MAL API shaped entry) for a dump record, or None.
+
+    Records can be MAL API nodes or Jikan entries. Manga is told apart by its
+    chapter and volume counts unless the record has a kind.
+    """
+    if 'node' in entry:
+        entry = entry['node']
+    kind = entry.pop('kind', None)
+    if kind is None:
+        manga = any(field in entry for field in ('num_chapters', 'num_volumes', 'chapters', 'volumes', 'published'))
+        kind = 'manga' if manga else 'anime'
+
+    if 'mal_id' in entry:
+        entry = jikanMangaToMal(entry) if kind == 'manga' else jikanToMal(entry)
+    if not entry.get('id') or not entry.get('title'):
+        return None
+    return (kind, entry)
+
+def iterJSONArray(f, chunk_size=1 << 20):
+    """Yields the values of the first JSON array in a file without reading it whole."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = -1
+    while pos < 0:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        buffer += chunk
+        pos = buffer.find('[')
+    pos += 1
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        try:
+            if pos == len(buffer):
+                raise ValueError
+            value, pos = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                if pos < len(buffer):
+                    raise
+                return
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield value
+        if pos > chunk_size:
+            buffer = buffer[pos:]
+            pos = 0
+
+def iterDump(filename):
+    """Yields the records of a dump file, one at a time."""
+    opener = gzip.open if filename.endswith('.gz') else open
+    base = filename[:-len('.gz')] if filename.endswith('.gz') else filename
+
+    with opener(filename, 'rt', newline='', encoding='utf-8') as f:
+        if base.endswith('.csv'):
+            yield from (csvDumpEntry(row) for row in csv.DictReader(f))
+        elif base.endswith('.jsonl') or base.endswith('.ndjson'):
+            yield from (jsonLoads(line) for line in f if line.strip())
+        else:
+            yield from iterJSONArray(f)
+
+def importDump():
+    """Streams a metadata dump into the anime and manga stores and their title indexes.
+
+    Entries already in a store are kept, like every other store write. Entries
+    count as fetched when the dump file was written, so --refresh-store sees
+    how old they really are.
+    """
+    if store_index is None:
+        loadStoreIndex()
+    os.makedirs(MANGA_STORE, exist_ok=True)
+    dumpDate = datetime.datetime.fromtimestamp(os.path.getmtime(args.import_dump)).isoformat(timespec='seconds')
+
+    stores = {'anime': 'mal_store', 'manga': MANGA_STORE}
+    indexRows = {'anime': [], 'manga': []}
+    added = {'anime': 0, 'manga': 0}
+    existing = 0
+    invalid = 0
+
+    for count, record in enumerate(iterDump(args.import_dump), 1):
+        result = dumpEntry(record) if isinstance(record, dict) else None
+        if result is None:
+            invalid += 1
+            continue
+
+        kind, entry = result
+        entry.setdefault('_fetched_at', dumpDate)
+        fname = stores[kind] + '/' + str(entry['id']) + '.json'
+        with mal_store_lock:
+            stored = mal_store_check_by_fname(fname)
+            if not stored:
+                tmp_file = tmpName(fname)
+                saveJSON(entry, tmp_file)
+                os.replace(tmp_file, fname)
+        if stored:
+            existing += 1
+        else:
+            added[kind] += 1
+            indexRows[kind].extend([title, str(entry['id'])] for title in storeTitles(entry))
+
+        if count % 10000 == 0 and not args.quiet:
+            print("Read " + str(count) + " records...")
+
+    for kind, rows in indexRows.items():
+        index_file = stores[kind] + '/index.csv'
+        with fileLock(index_file):
+            appendRows(index_file, rows)
+    for title, mal_id in indexRows['anime']:
+        storeIndexAdd(title, mal_id)
+
+    flushLog()
+    print("=================================")
+    logger.info("Anime added: " + str(added['anime']), extra=SUMMARY)
+    logger.info("Manga added: " + str(added['manga']), extra=SUMMARY)
+    logger.info("Already stored: " + str(existing), extra=SUMMARY)
+    logger.info("Invalid records: " + str(invalid), extra=SUMMARY)
 
 def mal_store_check_by_fname(fname):
     if os.path.isfile(fname):
@@ -1046,25 +3702,692 @@ def mal_store_check_by_id(mal_id):
         return True
     return False
 
+# store entries already read this process, kept for the lifetime of the service
+mal_store_memory = {}
+
 def get_mal_store_data_by_id(mal_id):
-    fname = 'mal_store/'+str(mal_id)+'.json'
-    with open(fname, encoding='utf-8') as f:
-        data = json.load(f)
+    mal_id = str(mal_id)
+    if mal_id in mal_store_memory:
+        return mal_store_memory[mal_id]
+
+    fname = 'mal_store/'+mal_id+'.json'
+    data = loadJSON(fname)
+    mal_store_memory[mal_id] = data
+    return data
+
+# statuses of entries whose episode or chapter counts and titles can still change
+STORE_CHANGING_STATUSES = {'currently_airing', 'not_yet_aired', 'currently_publishing', 'not_yet_published', 'on_hiatus'}
+
+def storeFetchedAt(entry, fname):
+    """When a store entry was fetched, entries stored without a timestamp count from their file."""
+    if entry.get('_fetched_at'):
+        return datetime.datetime.fromisoformat(entry['_fetched_at'])
+    return datetime.datetime.fromtimestamp(os.path.getmtime(fname))
+
+def storeMayChange(entry, count_field):
+    """True for entries that are still running or don't know their episode or chapter count yet."""
+    status = entry.get('status')
+    if status:
+        if status in STORE_CHANGING_STATUSES:
+            return True
+    elif not entry.get('end_date'):
+        # stored before statuses were kept, no end date means it may still be running
+        return True
+    return not entry.get(count_field)
+
+def fetchStoreEntry(kind, mal_id):
+    """Fetches an anime or manga entry by ID from the MAL API with --mal-api, otherwise Jikan.
+
+    Returns the entry with the MAL API fields kept in the store, or False.
+    """
+    if args.mal_api:
+        provider = 'mal'
+        fields = MAL_DETAIL_FIELDS if kind == 'anime' else MAL_MANGA_FIELDS
+        url = "https://api.myanimelist.net/v2/" + kind + "/" + mal_id + "?fields=" + fields + "&nsfw=true"
+        headers = {'X-MAL-CLIENT-ID': MAL_CLIENT_ID}
+    else:
+        provider = 'jikan'
+        url = "https://api.jikan.moe/v4/" + kind + "/" + mal_id
+        headers = None
+
+    delayCheck(args.api_delay, provider)
+    try:
+        response = apiGet(url, headers=headers)
+        if response.status_code != 200:
+            logger.error(provider.upper() + " Error: " + str(response.status_code) + " --- ID: " + mal_id)
+            return False
+        data = jsonLoads(response.content)
+    except BudgetExceeded:
+        return False
+    except requests.Timeout:
+        logger.error(provider.upper() + " request timed out -- ID: " + mal_id)
+        return False
+    except:
+        logger.error(provider.upper() + " request failed -- ID: " + mal_id)
+        return False
+
+    if provider == 'jikan':
+        return jikanMangaToMal(data['data']) if kind == 'manga' else jikanToMal(data['data'])
     return data
 
+def refreshStore():
+    """Re-fetches the store entries older than --store-ttl days that may have changed since.
+
+    Finished entries with known counts are left alone. Fields the API didn't
+    return are kept from the stored entry.
+    """
+    if args.mal_api and not MAL_CLIENT_ID:
+        print("Error: MAL API access required.")
+        return
+
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=args.store_ttl)
+    stores = (('anime', 'mal_store', 'num_episodes'), ('manga', MANGA_STORE, 'num_chapters'))
+    stale = []
+    total = 0
+    for kind, store, count_field in stores:
+        for fname in storeIndexFiles(store):
+            total += 1
+            entry = loadJSON(fname)
+            if storeFetchedAt(entry, fname) < cutoff and storeMayChange(entry, count_field):
+                stale.append((kind, store, fname, entry))
+    logger.info("Stale store entries: " + str(len(stale)) + " of " + str(total), extra=SUMMARY)
+
+    refreshed = 0
+    updated = 0
+    failed = 0
+    reindex = set()
+    for count, (kind, store, fname, old) in enumerate(stale, 1):
+        if budgetExceeded():
+            break
+        progress(count, len(stale))
+        fresh = fetchStoreEntry(kind, str(old['id']))
+        if not fresh:
+            failed += 1
+            continue
+
+        entry = dict(old)
+        entry.update(fresh)
+        entry['_fetched_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+        if {k: v for k, v in entry.items() if k != '_fetched_at'} != {k: v for k, v in old.items() if k != '_fetched_at'}:
+            updated += 1
+            logger.info("Updated store entry: " + entry['title'] + " --> " + str(entry['id']))
+        if storeTitles(entry) != storeTitles(old):
+            reindex.add(store)
+
+        with mal_store_lock:
+            tmp_file = tmpName(fname)
+            saveJSON(entry, tmp_file)
+            os.replace(tmp_file, fname)
+            if kind == 'anime':
+                mal_store_memory[str(entry['id'])] = entry
+        refreshed += 1
+
+    for store in sorted(reindex):
+        rebuildStoreIndex(store)
+    if 'mal_store' in reindex and store_index is not None:
+        loadStoreIndex()
+
+    flushLog()
+    print("=================================")
+    logger.info("Refreshed: " + str(refreshed), extra=SUMMARY)
+    logger.info("Changed: " + str(updated), extra=SUMMARY)
+    logger.info("Failed: " + str(failed), extra=SUMMARY)
+
+RELATED_STORE = 'mal_store/related'
+
+# mapped entries searched for in one franchise lookup, the rest are left to the API
+FRANCHISE_ROOTS = 5
+# related titles scoring at least this much are offered for confirmation
+FRANCHISE_CONFIRM = 0.7
+
+# MAL ID -> related entries, False when fetching them failed this run
+related_graphs = {}
+related_lock = threading.Lock()
+
+def fetchRelated(mal_id):
+    """Fetches the related anime of an entry, returns [{id, title, relation}] or False.
+
+    With --mal-api the entry's details come along and are kept in the MAL store.
+    """
+    if args.mal_api:
+        provider = 'mal'
+        url = "https://api.myanimelist.net/v2/anime/" + mal_id + "?fields=" + MAL_DETAIL_FIELDS + ",related_anime&nsfw=true"
+        headers = {'X-MAL-CLIENT-ID': MAL_CLIENT_ID}
+    else:
+        provider = 'jikan'
+        url = "https://api.jikan.moe/v4/anime/" + mal_id + "/relations"
+        headers = None
+
+    delayCheck(args.api_delay, provider)
+    try:
+        response = apiGet(url, headers=headers)
+        if response.status_code != 200:
+            logger.error(provider.upper() + " Error: " + str(response.status_code) + " --- ID: " + mal_id)
+            return False
+        data = jsonLoads(response.content)
+    except BudgetExceeded:
+        return False
+    except requests.Timeout:
+        logger.error(provider.upper() + " request timed out -- ID: " + mal_id)
+        return False
+    except:
+        logger.error(provider.upper() + " request failed -- ID: " + mal_id)
+        return False
+
+    if provider == 'jikan':
+        return [{"id": str(entry['mal_id']), "title": entry['name'], "relation": group['relation'].lower().replace(' ', '_')}
+                for group in data['data'] for entry in group['entry'] if entry['type'] == 'anime']
+
+    related = data.pop('related_anime', [])
+    mal_store_save(data)
+    return [{"id": str(entry['node']['id']), "title": entry['node']['title'], "relation": entry['relation_type']}
+            for entry in related]
+
+def relatedGraph(mal_id, fetch=True):
+    """Returns the related entries of a MAL entry, fetched once and kept in mal_store/related.
+
+    Returns False if they aren't stored and can't (or shouldn't) be fetched.
+    """
+    with related_lock:
+        if mal_id in related_graphs:
+            return related_graphs[mal_id]
+
+        fname = RELATED_STORE + '/' + mal_id + '.json'
+        if os.path.isfile(fname):
+            related = loadJSON(fname)['related']
+        elif not fetch:
+            return False
+        else:
+            related = fetchRelated(mal_id)
+            if related is not False:
+                os.makedirs(RELATED_STORE, exist_ok=True)
+                tmp_file = tmpName(fname)
+                saveJSON({"id": mal_id, "_fetched_at": datetime.datetime.now().isoformat(timespec='seconds'), "related": related}, tmp_file)
+                os.replace(tmp_file, fname)
+        related_graphs[mal_id] = related
+        return related
+
+def franchiseRoots(name):
+    """Returns the MAL IDs mapped for the title's franchise, most similar mapped title first."""
+    if franchise_index is None:
+        loadFranchises()
+    mapped = franchise_index.get(franchiseKey(name), {})
+    roots = sorted(mapped, key=lambda mal_id: titleSimilarity(name, mapped[mal_id]), reverse=True)
+    return roots[:FRANCHISE_ROOTS]
+
+def franchiseOptions(roots):
+    """Returns the entries related to the roots as options, from graphs already loaded or stored.
+
+    Graphs stored for the related entries are followed one step further.
+    """
+    titles = {}
+    for root in roots:
+        related = relatedGraph(root, False) or []
+        for entry in related:
+            titles.setdefault(entry['id'], []).append(entry['title'])
+        for entry in related:
+            for further in relatedGraph(entry['id'], False) or []:
+                titles.setdefault(further['id'], []).append(further['title'])
+
+    options = []
+    for mal_id, relatedTitles in titles.items():
+        if mal_store_check_by_id(mal_id):
+            relatedTitles = relatedTitles + storeTitles(get_mal_store_data_by_id(mal_id))
+        options.append(Candidate(mal_id, list(dict.fromkeys(relatedTitles))))
+    return options
+
+def franchiseMatch(name, fetch=True):
+    """Returns the ranked franchise options for a title.
+
+    Stored graphs are tried first. Without an option worth confirming the graph
+    of the most similar mapped entry not stored yet is fetched, one per lookup,
+    so a title outside the graph costs at most one fetch before its search.
+    """
+    roots = franchiseRoots(name)
+    options = rankOptions(name, franchiseOptions(roots))
+    if not fetch or (options and options[0].score >= FRANCHISE_CONFIRM):
+        return options
+
+    for root in roots:
+        if relatedGraph(root, False) is not False:
+            continue
+        if relatedGraph(root):
+            options = rankOptions(name, franchiseOptions(roots))
+        break
+    return options
+
+def franchiseSearch(name):
+    """Matches a title against the related entries of its mapped franchise, returns the MAL ID or False.
+
+    A graph fetch for one mapped entry replaces a search for each of the
+    franchise's other titles. Related entries are told apart by title alone
+    (sequels, movies and recaps share most of it), so matches are only offered
+    for confirmation, never accepted without asking.
+    """
+    options = franchiseMatch(name)
+    if not options:
+        return False
+
+    best = options[0]
+    if not args.skip_confirm and best.score >= FRANCHISE_CONFIRM:
+        if aliasConfirm(best.titles[0], best.id, "related title"):
+            return best.id
+    return False
+
+def convertExport(data):
+    """Converts an already loaded export using only the local mappings.
+
+    Returns the MAL XML and the titles that still need a mapping. Unresolved titles
+    are added to the unmapped queue the same way a --cache-only run adds them.
+    """
+    output = OutputStage(data['user']['name'], [('xml', None, False)])
+    cachedEntries, notFoundEntries, badEntries = getInitialCounts(data, output)
+
+    return {
+        "user": data['user']['name'],
+        "xml": output.close(len(cachedEntries))[0],
+        "unresolved": [entry['name'] for entry in notFoundEntries],
+        "bad": [entry['name'] for entry in badEntries],
+        "total": len(data['entries']),
+        "cache_found": len(cachedEntries),
+    }
+
+def serve():
+    """Runs the converter as a local HTTP service.
+
+    POST an Anime Planet export to /convert to get back JSON holding the MAL XML
+    and the unresolved titles. Mappings stay loaded between requests and are
+    reloaded when a mapping file changes on disk.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import threading
+
+    lock = threading.Lock()
+
+    class ConvertHandler(BaseHTTPRequestHandler):
+        def sendJSON(self, status, body):
+            payload = jsonDumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path != '/health':
+                self.sendJSON(404, {"error": "not found"})
+                return
+            self.sendJSON(200, {
+                "cache": len(cache_data),
+                "bad": len(bad_index),
+                "unmapped": len(unmapped_index),
+            })
+
+        def do_POST(self):
+            if self.path != '/convert':
+                self.sendJSON(404, {"error": "not found"})
+                return
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                data = jsonLoads(self.rfile.read(length))
+                data['user']['name']
+                if any(not isinstance(entry['name'], str) for entry in data['entries']):
+                    raise TypeError("entry name must be a string")
+            except (ValueError, KeyError, TypeError):
+                self.sendJSON(400, {"error": "body must be an Anime Planet export"})
+                return
+
+            try:
+                with lock:
+                    if reloadMappings():
+                        logger.info("Mapping files changed, reloaded")
+                    result = convertExport(data)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error("[SERVICE] Invalid entry in export: " + repr(e))
+                self.sendJSON(400, {"error": "invalid entry in export: " + repr(e)})
+                return
+            except Exception as e:
+                logger.exception("[SERVICE] Conversion failed")
+                self.sendJSON(500, {"error": "conversion failed: " + repr(e)})
+                return
+
+            self.sendJSON(200, result)
+
+        def log_message(self, format, *log_args):
+            logger.debug("[SERVICE] " + (format % log_args))
+
+    server = ThreadingHTTPServer((args.host, args.port), ConvertHandler)
+    logger.info("Conversion service listening on http://" + args.host + ":" + str(args.port) + "/convert", extra=SUMMARY)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping conversion service...")
+    finally:
+        server.server_close()
+
+def benchmarkSearchPayload(num_entries=10):
+    """Builds a MAL search response shaped like a detail search."""
+    data = []
+    for i in range(num_entries):
+        data.append({"node": {
+            "id": 1000 + i,
+            "title": "Benchmark Title " + str(i),
+            "main_picture": {"medium": "https://cdn.myanimelist.net/images/anime/1/1000.jpg"},
+            "alternative_titles": {"synonyms": ["Bench " + str(i)], "en": "Benchmark English " + str(i), "ja": "\u30d9\u30f3\u30c1"},
+            "start_date": "2011-04-01",
+            "end_date": "2011-06-24",
+            "media_type": "tv",
+            "num_episodes": 12,
+            "start_season": {"year": 2011, "season": "spring"},
+            "source": "manga",
+            "average_episode_duration": 1440,
+            "studios": [{"id": 4, "name": "Bones"}],
+        }})
+    return {"data": data, "paging": {"next": "https://api.myanimelist.net/v2/anime?offset=10"}}
+
+def benchmarkTime(func, number):
+    import timeit
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1000000
+
+def benchmarkMemory(build):
+    """Returns the bytes still allocated by what build() returns."""
+    import tracemalloc
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+def benchmark():
+    """Times the hot local code paths without touching the network."""
+    number = 2000
+    print("JSON backend: " + ("orjson" if orjson is not None else "json"))
+
+    payload = benchmarkSearchPayload()
+    raw = json.dumps(payload).encode('utf-8')
+    old = benchmarkTime(lambda: json.loads(json.dumps(json.loads(raw.decode('utf-8')))), number)
+    new = benchmarkTime(lambda: jsonLoads(raw), number)
+    print("[API response, " + str(len(raw)) + " bytes]")
+    print("  parse + round trip: %.1f us/call" % old)
+    print("  jsonLoads:          %.1f us/call (%.1f us saved)" % (new, old - new))
+
+    store = payload['data'][0]['node']
+    indented = json.dumps(store, ensure_ascii=False, indent=4)
+    compact = jsonDumps(store)
+    old = benchmarkTime(lambda: json.dumps(store, ensure_ascii=False, indent=4), number)
+    new = benchmarkTime(lambda: jsonDumps(store), number)
+    print("[MAL store entry]")
+    print("  indent=4: %d bytes, %.1f us/encode" % (len(indented.encode('utf-8')), old))
+    print("  compact:  %d bytes, %.1f us/encode" % (len(compact.encode('utf-8')), new))
+    old = benchmarkTime(lambda: json.loads(indented), number)
+    new = benchmarkTime(lambda: jsonLoads(compact), number)
+    print("  read indent=4: %.1f us/call, read compact: %.1f us/call" % (old, new))
+
+    rows = processCacheFiles(args.cache_file)
+    print("[Mapping table, " + str(len(rows)) + " rows]")
+    old = benchmarkMemory(lambda: processCacheFiles(args.cache_file))
+    new = benchmarkMemory(lambda: MappingTable(processCacheFiles(args.cache_file)))
+    print("  list rows:     %.1f bytes/row" % (old / len(rows)))
+    print("  MappingTable:  %.1f bytes/row" % (new / len(rows)))
+
+    entries = [entry['node'] for entry in payload['data']] * 100
+    old = benchmarkMemory(lambda: [malGetOption(entry).toDict() for entry in entries])
+    new = benchmarkMemory(lambda: [malGetOption(entry) for entry in entries])
+    print("[Search candidates, " + str(len(entries)) + " records]")
+    print("  dict:      %.1f bytes/record" % (old / len(entries)))
+    print("  Candidate: %.1f bytes/record" % (new / len(entries)))
+
+# search results a synthesized candidate list holds, like one page of search results
+BENCHMARK_CANDIDATES = 10
+
+def benchmarkTruth(cache_file, bad_file):
+    """Returns the labelled titles: mapped titles with their MAL ID, bad titles with None."""
+    truth = {}
+    for row in processCacheFiles(cache_file):
+        if len(row) >= 2:
+            truth.setdefault(row[0], row[1])
+    if os.path.isfile(bad_file):
+        for row in processCacheFiles(bad_file):
+            if row:
+                truth.setdefault(row[0], None)
+    return truth
+
+def benchmarkStore(store):
+    """Returns the entries of a store by ID and the IDs of each franchise name in it."""
+    entries = {}
+    franchises = {}
+    for fname in storeIndexFiles(store):
+        entry = loadJSON(fname)
+        mal_id = str(entry['id'])
+        entries[mal_id] = entry
+        for title in storeTitles(entry):
+            franchises.setdefault(franchiseKey(title), set()).add(mal_id)
+    return entries, franchises
+
+# where a title's candidate list came from, reported separately
+BENCHMARK_SOURCES = [
+    ('recorded', "Recorded search results"),
+    ('synthetic', "Synthesized from the store (the right entry is always listed, optimistic)"),
+    ('local', "Without a candidate list"),
+]
+
+def benchmarkCandidates(name, mal_id, recorded, entries, franchises):
+    """Returns the candidate list of a title and its source: its recorded search results, or stored entries.
+
+    Synthesized lists hold the stored entry of the title (if stored) and stored
+    entries of the same franchise as the likely wrong answers. The list is None
+    if there is nothing to match against.
+    """
+    if name in recorded:
+        return recorded[name], 'recorded'
+
+    others = sorted(franchises.get(franchiseKey(name), set()) - {mal_id}, key=int)
+    ids = others[:BENCHMARK_CANDIDATES - 1]
+    if mal_id in entries:
+        ids = sorted(ids + [mal_id], key=int)
+    elif mal_id is not None:
+        return None, 'local'
+    if not ids:
+        return None, 'local'
+    return [entries[id] for id in ids], 'synthetic'
+
+def benchmarkAliases(truth):
+    """Indexes the mapped titles by alias keys, keeping every title so a title can leave itself out."""
+    groups = {}
+    lossy = {}
+    for title, mal_id in truth.items():
+        if mal_id is not None:
+            groups.setdefault(aliasKey(title), {})[title] = mal_id
+            lossy.setdefault(lossyAliasKey(title), {})[title] = mal_id
+    return groups, lossy
+
+def benchmarkFranchises(truth):
+    """Indexes the mapped titles by franchise name, keeping every title so a title can leave itself out."""
+    groups = {}
+    for title, mal_id in truth.items():
+        key = franchiseKey(title)
+        if mal_id is not None and len(key) >= 3:
+            groups.setdefault(key, {})[title] = mal_id
+    return groups
+
+def benchmarkFranchise(name, groups):
+    # the franchise options of franchiseMatch() without fetching, if the title weren't mapped yet
+    mapped = {}
+    for title, mal_id in groups.get(franchiseKey(name), {}).items():
+        if title != name:
+            mapped.setdefault(mal_id, title)
+    roots = sorted(mapped, key=lambda mal_id: titleSimilarity(name, mapped[mal_id]), reverse=True)
+    return rankOptions(name, franchiseOptions(roots[:FRANCHISE_ROOTS]))
+
+def benchmarkAlias(name, index, key):
+    # the alias another mapped title gives, like aliasSearch() if the title weren't mapped yet
+    ids = set(mal_id for title, mal_id in index.get(key, {}).items() if title != name)
+    if len(ids) == 1:
+        return ids.pop()
+    return False
+
+def benchmarkDataset(label, truth, store, aliases, scoring, franchise=False):
+    """Replays the labelled titles of one dataset and prints the accuracy and latency of the matching.
+
+    Titles go through the local stages a search goes through (aliases, the
+    store index, franchise confirmations) and then the candidate list. A title
+    counts as auto-accepted when a stage picks an ID without asking, mapped
+    titles are correct when it's their ID, bad titles are never correct. Titles
+    matched against recorded and synthesized candidate lists are reported
+    separately.
+    """
+    recorded = loadResponseCache() if scoring else {}
+    entries, franchises = benchmarkStore(store)
+    storeTitleIndex = {}
+    for mal_id, entry in entries.items():
+        for title in storeTitles(entry):
+            key = title.casefold()
+            storeTitleIndex[key] = mal_id if storeTitleIndex.get(key, mal_id) == mal_id else None
+    if aliases:
+        groups, lossy = benchmarkAliases(truth)
+    if franchise:
+        franchiseGroups = benchmarkFranchises(truth)
+
+    tallies = {}
+    for source, title in BENCHMARK_SOURCES:
+        tallies[source] = {'stages': {}, 'evaluated': 0, 'mapped': 0, 'offered': 0, 'confirmations': 0, 'wrong': []}
+    skipped = 0
+    timings = []
+    for name, mal_id in truth.items():
+        started = time.perf_counter()
+        candidates, source = benchmarkCandidates(name, mal_id, recorded, entries, franchises)
+        found = False
+        stage = None
+        options = []
+        confirm = False
+        if aliases:
+            found = benchmarkAlias(name, groups, aliasKey(name))
+            stage = 'alias' if found else None
+        if not found and storeTitleIndex.get(name.casefold()):
+            found = storeTitleIndex[name.casefold()]
+            stage = 'store'
+        if not found and franchise:
+            # franchise matches are only offered for confirmation
+            related = benchmarkFranchise(name, franchiseGroups)
+            if related and related[0].score >= FRANCHISE_CONFIRM:
+                confirm = True
+                options = related[:1]
+        if not found and candidates:
+            found, stage, options = candidateMatch(name, candidates, scoring)
+        if not found and aliases and benchmarkAlias(name, lossy, lossyAliasKey(name)):
+            confirm = True
+        timings.append(time.perf_counter() - started)
+
+        if not found and not candidates and not confirm:
+            skipped += 1
+            continue
+        tally = tallies[source]
+        tally['evaluated'] += 1
+        tally['confirmations'] += confirm
+        if mal_id is not None:
+            tally['mapped'] += 1
+        if found:
+            total, correct = tally['stages'].get(stage, (0, 0))
+            tally['stages'][stage] = (total + 1, correct + (found == mal_id))
+            if found != mal_id:
+                tally['wrong'].append((name, found, mal_id))
+        elif mal_id is not None and mal_id in [option.id for option in options[:args.num_options]]:
+            tally['offered'] += 1
+
+    timings.sort()
+    print("[" + label + ", " + str(len(truth)) + " labelled titles]")
+    if len(timings) == skipped:
+        print("  No recorded search results or stored entries to match against")
+        return
+    print("  %d without candidates" % skipped)
+    print("  Latency: %.1f us/title avg, %.1f us p50, %.1f us p95" % (
+        sum(timings) / len(timings) * 1000000, timings[len(timings) // 2] * 1000000, timings[int(len(timings) * 0.95)] * 1000000))
+    for source, title in BENCHMARK_SOURCES:
+        if tallies[source]['evaluated']:
+            print("  " + title + ":")
+            benchmarkReport(tallies[source], scoring)
+
+def benchmarkReport(tally, scoring):
+    evaluated = tally['evaluated']
+    mapped = tally['mapped']
+    stages = tally['stages']
+    accepted = sum(total for total, correct in stages.values())
+    correct = sum(correct for total, correct in stages.values())
+
+    print("    Evaluated: %d (%d mapped, %d bad)" % (evaluated, mapped, evaluated - mapped))
+    print("    Auto-accepted: %d (%.1f%%)" % (accepted, 100 * accepted / evaluated))
+    print("    Precision: %.1f%%" % (100 * correct / accepted if accepted else 100))
+    print("    Recall: %.1f%%" % (100 * correct / mapped if mapped else 0))
+    if scoring:
+        print("    Correct ID among %d options: %d, confirmations: %d" % (args.num_options, tally['offered'], tally['confirmations']))
+    for stage, (total, right) in sorted(stages.items()):
+        print("    %-10s %d accepted, %d correct" % (stage + ':', total, right))
+    for name, found, mal_id in tally['wrong'][:10]:
+        print("    Wrong: " + name + " ---> " + found + " (" + (mal_id or "bad") + ")")
+
+def matchBenchmark():
+    """Measures the matching logic against the confirmed mappings, without touching the network.
+
+    Anime titles are replayed against the search results recorded in
+    --candidates-file, or lists built from the MAL store, reported apart.
+    Manga titles go through the manga store and exact matches, like
+    mangatransfer.py.
+    """
+    benchmarkDataset("Anime", benchmarkTruth(args.cache_file, args.bad_file), 'mal_store', args.aliases, True, args.franchise)
+    benchmarkDataset("Manga", benchmarkTruth(MANGA_CACHE_FILE, MANGA_BAD_FILE), MANGA_STORE, False, False)
+
 def main():
+    if args.benchmark:
+        benchmark()
+        return
+
+    if args.match_benchmark:
+        matchBenchmark()
+        return
+
+    if args.plan:
+        plan()
+        return
+
     if args.mal_api_store:
         mal_api_store()
         return
 
+    if args.refresh_store:
+        refreshStore()
+        return
+
     if args.cache_verify:
         cache_verify()
         return
 
+    if args.compact_mappings:
+        compactMappings()
+        return
+
+    if args.import_dump:
+        importDump()
+        return
+
+    if args.suggest:
+        suggestQueue()
+        return
+
     if args.search_queue:
         searchQueue()
         return
 
+    if args.serve:
+        serve()
+        return
+
+    if args.batch:
+        processBatch()
+        return
+
     processList()
 
 def script_timer():
@@ -1075,4 +4398,7 @@ def script_timer():
 
 if __name__ == "__main__":
     main()
+    logResolverStats()
+    if budget_stopped:
+        sys.exit(BUDGET_EXIT_CODE)
     # script_timer()
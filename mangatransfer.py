@@ -24,7 +24,8 @@ load_dotenv()
 
 MAL_CLIENT_ID = os.getenv('MAL_CLIENT_ID')
 
-current_datetime = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S");
+start_time = datetime.datetime.now()
+current_datetime = start_time.strftime("%Y-%m-%d_%H%M%S");
 
 DEFAULTS = {
     'api_delay': 1.5, # in seconds
@@ -37,6 +38,11 @@ DEFAULTS = {
     'mal_api': False,
     'num_options': 10,
     'limit': -1,
+    'connect_timeout': 5.0, # in seconds
+    'read_timeout': 20.0, # in seconds
+    'max_api_calls': -1,
+    'max_runtime': -1, # in minutes
+    'plan': False,
 }
 
 def parse_arguments():
@@ -102,6 +108,36 @@ def parse_arguments():
         default=DEFAULTS['num_options'],
         type=int
     )
+    parser.add_argument(
+        '--connect-timeout',
+        help='Seconds to wait for an API connection before giving up on the request',
+        default=DEFAULTS['connect_timeout'],
+        type=float
+    )
+    parser.add_argument(
+        '--read-timeout',
+        help='Seconds to wait for an API response before giving up on the request',
+        default=DEFAULTS['read_timeout'],
+        type=float
+    )
+    parser.add_argument(
+        '--max-api-calls',
+        help='Stops searching after this many API requests, progress is kept for the next run',
+        default=DEFAULTS['max_api_calls'],
+        type=int
+    )
+    parser.add_argument(
+        '--max-runtime',
+        help='Stops searching after this many minutes, progress is kept for the next run',
+        default=DEFAULTS['max_runtime'],
+        type=float
+    )
+    parser.add_argument(
+        '--plan',
+        help='Estimates the searches, API calls, runtime and output size of a run without making it.',
+        default=DEFAULTS['plan'],
+        action='store_true'
+    )
     parser.add_argument('manga_list')
 
     args = parser.parse_args()
@@ -131,12 +167,24 @@ def setupLogger(LOG_FILE_NAME = str(date.today())+".log"):
 
 logger = setupLogger(args.log_file)
 
+# orjson is used when installed, otherwise the standard library parser
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def jsonLoads(data):
+    """Parses JSON from bytes or str with the fastest available backend."""
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
 #Loads JSON file
 def loadJSON(filename):
-    f = open(filename, encoding='utf-8')
-    data = json.load(f)
-    f.close()
-    return data
+    with open(filename, 'rb') as f:
+        return jsonLoads(f.read())
 
 def cache(name, malid, cache_file):
     with open(cache_file, 'a', newline='', encoding='utf-8') as f:
@@ -184,6 +232,37 @@ def delayCheck(delay):
         time.sleep(diff)
     qtime = datetime.datetime.now()
 
+# exit code of runs stopped by --max-api-calls or --max-runtime, run again to continue
+BUDGET_EXIT_CODE = 75
+
+class BudgetExceeded(Exception):
+    """Raised instead of sending a request once the run is out of budget."""
+
+api_calls = 0
+budget_stopped = False
+
+def budgetExceeded():
+    """Returns why the run has to stop searching, or False while it's within budget."""
+    global budget_stopped
+    reason = False
+    if args.max_api_calls > -1 and api_calls >= args.max_api_calls:
+        reason = "API call budget of " + str(args.max_api_calls) + " reached"
+    elif args.max_runtime > 0 and (datetime.datetime.now() - start_time).total_seconds() >= args.max_runtime * 60:
+        reason = "Runtime budget of " + str(args.max_runtime) + " minutes reached"
+
+    if reason and not budget_stopped:
+        budget_stopped = True
+        logger.warning(reason + ", only using cached mappings for the rest. Run again to continue.")
+    return reason
+
+def apiGet(url, headers=None):
+    """GETs an API url with the connect and read deadlines, counting it against the budget."""
+    global api_calls
+    if budgetExceeded():
+        raise BudgetExceeded(url)
+    api_calls += 1
+    return requests.get(url, headers=headers, timeout=(args.connect_timeout, args.read_timeout))
+
 def jikanGetTitles(entry):
     titles = [entry['title']]
     if 'title_english' in entry and entry['title_english'] != None:
@@ -202,16 +281,20 @@ def jikanSearch(name):
     try:
         query = urllib.parse.quote_plus(str(name))
         url = "https://api.jikan.moe/v4/manga?q="+query
-        jikan = requests.get(url)
+        jikan = apiGet(url)
         if jikan.status_code == 400:
             logger.error("Jikan 400 -- "+name)
             return False
-        jfile = jikan.json()
+        jikanData = jsonLoads(jikan.content)
+    except BudgetExceeded:
+        return False
+    except requests.Timeout:
+        logger.error("Jikan request timed out -- "+name)
+        return False
     except:
         logger.error("Jikan request failed -- "+name)
         return False
 
-    jikanData = json.loads(json.dumps(jfile))
     if len(jikanData['data']) == 0:
         logger.error("Jikan search found no entries -- "+name)
         return False
@@ -260,16 +343,20 @@ def malSearch(full_name, assume_match=True):
         url = "https://api.myanimelist.net/v2/manga?q="+query
         fields = "id,title,alternative_titles,start_date,end_date,media_type,num_volumes,num_chapters"
         url += "&fields="+fields+"&nsfw=true"
-        mal = requests.get(url, headers=headers)
+        mal = apiGet(url, headers=headers)
         if mal.status_code == 400:
             logger.error("MAL 400 -- "+name)
             return False
-        malFile = mal.json()
+        malData = jsonLoads(mal.content)
+    except BudgetExceeded:
+        return False
+    except requests.Timeout:
+        logger.error("MAL request timed out -- "+name)
+        return False
     except:
         logger.error("MAL request failed -- "+name)
         return False
 
-    malData = json.loads(json.dumps(malFile))
     if len(malData['data']) == 0:
         logger.error("MAL search found no entries -- "+name)
         return False
@@ -296,25 +383,72 @@ def malSearch(full_name, assume_match=True):
         return False
     return selection
 
+MANGA_STORE = 'mal_store/manga'
+
+# casefolded MAL title -> MAL ID from the manga store, None when several share a title
+store_index = None
+
+def loadStoreIndex():
+    """Loads the manga title index written by anitransfer.py --import-dump."""
+    global store_index
+    store_index = {}
+    index_file = MANGA_STORE + '/index.csv'
+    if not os.path.isfile(index_file):
+        return
+
+    with open(index_file, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if len(row) != 2:
+                continue
+            key = row[0].casefold()
+            known = store_index.get(key, False)
+            if known is False:
+                store_index[key] = row[1]
+            elif known != row[1]:
+                store_index[key] = None
+
+def storeSearch(name):
+    """Returns the MAL ID of the stored manga with exactly this title, or False."""
+    if store_index is None:
+        loadStoreIndex()
+    mal_id = store_index.get(name.casefold())
+    if mal_id:
+        logger.info("MAL store match found: " + mal_id)
+        return mal_id
+    return False
+
+def getStoreChapters(mal_id):
+    fname = MANGA_STORE + '/' + str(mal_id) + '.json'
+    if not os.path.isfile(fname):
+        return False
+    # unfinished manga are stored with 0 chapters, those are asked again
+    return loadJSON(fname).get('num_chapters') or False
+
 def getMALChapters(mal_id):
-    num_chapters = 0
+    num_chapters = getStoreChapters(mal_id)
+    if num_chapters:
+        return num_chapters
 
     try:
         headers = {'X-MAL-CLIENT-ID': MAL_CLIENT_ID}
         url = "https://api.myanimelist.net/v2/manga/"+mal_id
         fields = "num_volumes,num_chapters"
         url += "?fields="+fields+"&nsfw=true"
-        mal = requests.get(url, headers=headers)
+        mal = apiGet(url, headers=headers)
         if mal.status_code == 400:
             logger.error("MAL 400 -- "+mal_id)
             return False
-        malFile = mal.json()
+        malData = jsonLoads(mal.content)
+    except BudgetExceeded:
+        return False
+    except requests.Timeout:
+        logger.error("MAL request timed out -- "+mal_id)
+        return False
     except:
         logger.error("MAL request failed -- "+mal_id)
         return False
     
 
-    malData = json.loads(json.dumps(malFile))
     num_chapters = malData['num_chapters']
     # num_volumes = malData['num_volumes']
     
@@ -379,6 +513,12 @@ def search(name):
         logger.error("Search title too small -- " + name)
         return False
 
+    storeResult = storeSearch(name)
+    if storeResult:
+        print('==============')
+        print()
+        return storeResult
+
     if args.mal_api:
         malResult = malSearch(name)
         print('==============')
@@ -403,6 +543,82 @@ def getConfirmInfo(name):
     planet_url = "https://www.anime-planet.com/manga/all?name="+query
     webbrowser.open(planet_url, new=2, autoraise=True)
 
+def xmlSize(tag, text, depth):
+    # size of one element as written by toprettyxml(indent='\t')
+    text = text.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+    return len(('\t' * depth + '<' + tag + '>' + text + '</' + tag + '>\n').encode('utf-8'))
+
+def plan(data):
+    """Reports the searches, chapter lookups, runtime and output size of a run without making it."""
+    with open(args.cache_file, newline='', encoding='utf-8') as f:
+        cached = {}
+        for row in csv.reader(f):
+            if row:
+                cached.setdefault(row[0], row[1])
+    with open(args.bad_file, newline='', encoding='utf-8') as f:
+        badTitles = set(row[0] for row in csv.reader(f) if row)
+    if store_index is None:
+        loadStoreIndex()
+
+    entries = data['entries']
+    if args.limit > -1:
+        entries = entries[:args.limit]
+
+    counts = {'cached': 0, 'bad': 0, 'store': 0, 'too_short': 0, 'remote': 0}
+    chapterLookups = 0
+    size = 0
+    for i in entries:
+        name = i['name']
+        if name in badTitles:
+            counts['bad'] += 1
+            continue
+
+        # same order as search(): short titles are never looked up in the store
+        foundID = cached.get(name)
+        if name in cached:
+            counts['cached'] += 1
+        elif len(name) < 3:
+            counts['too_short'] += 1
+            continue
+        elif store_index.get(name.casefold()):
+            counts['store'] += 1
+            foundID = store_index[name.casefold()]
+        else:
+            counts['remote'] += 1
+            foundID = '00000'
+
+        if i['status'] == "won't read":
+            continue
+        if i['status'] == 'read' and not (foundID != '00000' and getStoreChapters(foundID)):
+            chapterLookups += 1
+
+        # counted as if every search finds its title
+        size += len('\t<manga>\n\t</manga>\n')
+        for tag, text in (('manga_mangadb_id', foundID), ('manga_title', name), ('my_read_volumes', str(i['vol'])),
+                ('my_read_chapters', str(i['ch'])), ('my_start_date', '0000-00-00'), ('my_finish_date', '0000-00-00'),
+                ('my_score', str(int(i['rating']*2))), ('my_status', 'Plan to Read')):
+            size += xmlSize(tag, text, 2)
+
+    calls = (0 if args.cache_only else counts['remote']) + chapterLookups
+    # every request waits --api-delay after the one before it
+    seconds = calls * args.api_delay
+
+    print("=================================")
+    logger.info("Total Entries: " + str(len(entries)))
+    logger.info("Cache Found: " + str(counts['cached']))
+    logger.info("Bad Found: " + str(counts['bad']))
+    logger.info("MAL Store Matches: " + str(counts['store']))
+    logger.info("Too Short: " + str(counts['too_short']))
+    logger.info("Remote Lookups: " + str(0 if args.cache_only else counts['remote']))
+    logger.info("Chapter Lookups: " + str(chapterLookups))
+    logger.info(("MAL" if args.mal_api else "Jikan") + " search calls: " + str(0 if args.cache_only else counts['remote']))
+    logger.info("Estimated Time: " + str(datetime.timedelta(seconds=round(seconds))))
+    if args.max_api_calls > 0 and calls > args.max_api_calls:
+        logger.info("Runs with --max-api-calls " + str(args.max_api_calls) + ": " + str(math.ceil(calls / args.max_api_calls)))
+    if args.max_runtime > 0 and seconds > args.max_runtime * 60:
+        logger.info("Runs with --max-runtime " + str(args.max_runtime) + ": " + str(math.ceil(seconds / (args.max_runtime * 60))))
+    logger.info("Output convert.xml: ~" + str(round(size / 1024, 1)) + " KB")
+
 def main():
     #Start MAL XML structure
     root = ET.Element('myanimelist')
@@ -413,6 +629,10 @@ def main():
     data = loadJSON(args.manga_list)
     uname.text = data['user']['name']
 
+    if args.plan:
+        plan(data)
+        return
+
     count = 0
     cacheFound = 0
     badFound = 0
@@ -436,7 +656,7 @@ def main():
 
         foundID = cacheSearch(name, args.cache_file)
         if foundID == False:
-            if args.cache_only:
+            if args.cache_only or budgetExceeded():
                 logger.info('CACHE ONLY: Skipping search')
                 notFound += 1
                 logger.error("Couldn't find title -- "+name)
@@ -484,8 +704,12 @@ def main():
         read_chapters.text = str(i['ch'])
 
         if stat == "Completed":
-            read_chapters.text = str(getMALChapters(foundID))
-            delayCheck(args.api_delay)
+            stored_chapters = getStoreChapters(foundID)
+            if stored_chapters:
+                read_chapters.text = str(stored_chapters)
+            elif not budgetExceeded():
+                read_chapters.text = str(getMALChapters(foundID))
+                delayCheck(args.api_delay)
 
         start_date.text = "0000-00-00"
         finish_date.text = "0000-00-00"
@@ -522,3 +746,5 @@ def main():
 
 if __name__ == "__main__":
     main()
+    if budget_stopped:
+        sys.exit(BUDGET_EXIT_CODE)